@@ -19,7 +19,7 @@ from transformers import (
     LlamaTokenizer,
     LlamaForCausalLM,
 )
-from utils import prepare_model_for_eval, load_bnn, generate_sample_test
+from utils import prepare_model_for_eval, load_bnn, generate_sample_test, freeze_quant_weights
 import torch.nn.functional as F
 from evaluate import evaluate_model
 
@@ -45,6 +45,8 @@ def main(args):
 
 
     model = prepare_model_for_eval(model)
+    if not args.no_quant_cache:
+        freeze_quant_weights(model)
 
     # generate_sample_test(model,tokenizer)
 
@@ -108,6 +110,12 @@ if __name__ == "__main__":
         help="mmlu eval number of few-shot, default is 5",
     )
 
+    parser.add_argument(
+        "--no_quant_cache",
+        action="store_true",
+        help="re-quantize the binary weights on every forward instead of caching them once",
+    )
+
     args = parser.parse_args()
 
     main(args)
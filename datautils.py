@@ -3,6 +3,7 @@ import numpy as np
 import torch
 from datasets import load_dataset
 import random
+from gptq_pb.tokenstore import tokenizer_hash
 
 """
 doc https://huggingface.co/docs/datasets/loading
@@ -37,7 +38,7 @@ def get_english_quote(dataset_name, tokenizer):
     return data["train"]
 
 
-def get_qat_dataset(name, tokenizer, data_percent):
+def get_qat_dataset(name, tokenizer, data_percent, index_column=None):
     if name == "red_pajama":
         data = get_redpajama_train(tokenizer, data_percent)
 
@@ -45,6 +46,9 @@ def get_qat_dataset(name, tokenizer, data_percent):
         data = get_english_quote(name, tokenizer)
     else:
         raise NotImplementedError
+    if index_column is not None:
+        # stable sample ids, e.g. to look up cached teacher outputs
+        data = data.add_column(index_column, list(range(len(data))))
     data = data.shuffle()
     return data
 
@@ -133,16 +137,16 @@ def get_ptb(nsamples, seed, seqlen, model, cache_dir):
     return trainloader, testenc
 
 
-def get_ptq_calib_data(name, tokenizer, model_id, nsamples, seqlen=2048, seed=3):
-    print(f" get_ptq_calib_data {name}, nsamples={nsamples}, seqlen={seqlen}, {seed}")
-    cache_file = (
-        f"cache/{name}_{model_id.replace('/','_')}_{nsamples}_{seqlen}_{seed}.pt"
-    )
-    if not os.path.exists("cache"):
-        os.makedirs("cache")
+def get_token_stream(name, tokenizer, num_proc=None, batch_size=1000):
+    """
+    The train split of `name` tokenized once into a flat int32 token stream,
+    documents separated by the tokens of "\n\n" like the joined text used to
+    be. Tokenized in batches by datasets.map over `num_proc` processes (all
+    cores by default) and cached per tokenizer as a memory-mapped .npy file.
+    """
+    cache_file = f"cache/{name}_{tokenizer_hash(tokenizer)}_tokens.npy"
     if os.path.exists(cache_file):
-        traindataset = torch.load(cache_file)
-        return traindataset
+        return np.load(cache_file, mmap_mode="r")
     if name == "c4":
         traindata = load_dataset(
             "allenai/c4",
@@ -150,22 +154,73 @@ def get_ptq_calib_data(name, tokenizer, model_id, nsamples, seqlen=2048, seed=3)
             data_files={"train": "en/c4-train.00000-of-01024.json.gz"},
             split="train",
         )
-        tot_text = "\n\n".join(traindata["text"])
     elif name == "wikitext2":
         traindata = load_dataset("wikitext", "wikitext-2-raw-v1", split="train")
-        tot_text = "\n\n".join(traindata["text"])
     else:
         raise NotImplementedError
-    print(f"tot_text={len(tot_text)}")
+
+    def tokenization(example):
+        return tokenizer(example["text"], add_special_tokens=False)
+
+    tokenized = traindata.map(
+        tokenization,
+        batched=True,
+        batch_size=batch_size,
+        num_proc=num_proc or os.cpu_count(),
+        remove_columns=traindata.column_names,
+    )
+    sep = np.asarray(tokenizer("\n\n", add_special_tokens=False)["input_ids"], dtype=np.int32)
+    lengths = tokenized.map(
+        lambda batch: {"n": [len(ids) for ids in batch["input_ids"]]},
+        batched=True,
+        batch_size=batch_size,
+        num_proc=num_proc or os.cpu_count(),
+        remove_columns=tokenized.column_names,
+    )["n"]
+    total = sum(lengths) + len(sep) * (len(lengths) - 1)
+    print(f"tokens={total}")
+    # filled batch by batch, then renamed: an interrupted build leaves no
+    # truncated cache behind
+    tmp_file = cache_file + ".tmp"
+    stream = np.lib.format.open_memmap(tmp_file, mode="w+", dtype=np.int32, shape=(total,))
+    pos = 0
+    for st in range(0, len(tokenized), batch_size):
+        for j, ids in enumerate(tokenized[st : st + batch_size]["input_ids"]):
+            if st + j:
+                stream[pos : pos + len(sep)] = sep
+                pos += len(sep)
+            stream[pos : pos + len(ids)] = ids
+            pos += len(ids)
+    stream.flush()
+    del stream
+    os.replace(tmp_file, cache_file)
+    return np.load(cache_file, mmap_mode="r")
+
+
+def get_ptq_calib_data(name, tokenizer, model_id, nsamples, seqlen=2048, seed=3, num_proc=None):
+    print(f" get_ptq_calib_data {name}, nsamples={nsamples}, seqlen={seqlen}, {seed}")
+    # keyed on the tokenizer; model_id is unused, kept for the callers
+    cache_file = f"cache/{name}_{tokenizer_hash(tokenizer)}_{nsamples}_{seqlen}_{seed}.pt"
+    if not os.path.exists("cache"):
+        os.makedirs("cache")
+    if os.path.exists(cache_file):
+        traindataset = torch.load(cache_file)
+        return traindataset
+    stream = get_token_stream(name, tokenizer, num_proc)
+    # what the tokenizer adds around any text (e.g. BOS), as a per-sample
+    # tokenizer call did
+    prefix = np.asarray(tokenizer("")["input_ids"], dtype=np.int32)
+    n = seqlen - len(prefix)
+    rng = random.Random(seed)
     traindataset = []
     for _ in range(nsamples):
-        i = random.randint(0, len(tot_text) - seqlen - 1)
-        j = i + seqlen * 10
-        trainenc = tokenizer(tot_text[i:j], return_tensors="pt")
-        inp = trainenc.input_ids[:, :seqlen]
+        i = rng.randint(0, len(stream) - n - 1)
+        inp = torch.from_numpy(np.concatenate([prefix, stream[i : i + n]]).astype(np.int64))
+        inp = inp.unsqueeze(0)
         attention_mask = torch.ones_like(inp)
         traindataset.append({"input_ids": inp, "attention_mask": attention_mask})
-    torch.save(traindataset, cache_file)
+    torch.save(traindataset, cache_file + ".tmp")
+    os.replace(cache_file + ".tmp", cache_file)
     return traindataset
 
 
@@ -3,6 +3,7 @@ import torch.nn as nn
 from tqdm import tqdm
 import os
 from datautils import get_loaders
+from gptq_pb.lm_loss import window_starts, window_nll
 from lm_eval.base import BaseLM
 from lm_eval import evaluator
 import time
@@ -94,12 +95,15 @@ def evaluate_model(
     cache_dir="./data/",
     limit=-1,
     batch_size=1,
+    stride=None,
 ):
     """
     model: model name
     limit: number of test samples for debug, set to -1 is no limit
     tasks: str tasks are split by ,
     num_fewshot: Number of examples in few-shot context
+    batch_size: also the number of perplexity windows forwarded together
+    stride: start a perplexity window every `stride` tokens (default seqlen)
     """
     lm = EvalLM(model, tokenizer, batch_size=batch_size)
     results = {}
@@ -142,35 +146,28 @@ def evaluate_model(
                     testloader.input_ids
                 )  # 有个小坑 如果某个input_ids 有超过2*2048个词，nsamples 就不准了
 
-            nsamples = testenc.numel() // lm.seqlen
+            # same windows and scoring as gptq_pb/eval_ppl_utils.eval_ppl
+            tokens = testenc.reshape(-1)
+            starts = window_starts(tokens.numel(), lm.seqlen, stride)
+            if limit > 0:
+                starts = starts[:limit]
+            body = lm.model.model.decoder if "opt" in model_name else lm.model.model
             use_cache = lm.model.config.use_cache
             lm.model.config.use_cache = False
             lm.model.eval()
-            nlls = []
-
-            for i in tqdm(range(nsamples)):
-                batch = testenc[:, (i * lm.seqlen) : ((i + 1) * lm.seqlen)].to(
-                    lm.device
-                )
-                if "opt" in model_name:
-                    outputs = lm.model.model.decoder(batch)
-                elif "llama" in model_name:
-                    outputs = lm.model.model(batch)
-                hidden_states = outputs[0]  # .to(lm.model.lm_head.weight.device)
-                logits = lm.model.lm_head(hidden_states)  # .contiguous()
-                shift_logits = logits[:, :-1, :]  # .contiguous()
-                shift_labels = testenc[:, (i * lm.seqlen) : ((i + 1) * lm.seqlen)][
-                    :, 1:
-                ].to(lm.model.lm_head.weight.device)
-                loss_fct = nn.CrossEntropyLoss()
-                loss = loss_fct(
-                    shift_logits.view(-1, shift_logits.size(-1)),
-                    shift_labels.view(-1),
+            nll, count = 0, 0
+
+            for i, st in enumerate(tqdm(range(0, len(starts), batch_size))):
+                batch_starts = starts[st : st + batch_size]
+                batch = torch.stack(
+                    [tokens[b : b + lm.seqlen] for b in batch_starts]
+                ).to(lm.device)
+                hidden_states = body(batch)[0]  # .to(lm.model.lm_head.weight.device)
+                window_nll_sum, window_count = window_nll(
+                    lm.model.lm_head, hidden_states, tokens, batch_starts, lm.seqlen, stride
                 )
-                neg_log_likelihood = loss.float() * lm.seqlen
-                nlls.append(neg_log_likelihood)
-                if i == limit:
-                    break
+                nll = nll + window_nll_sum.double()
+                count += window_count
                 if i == 1:
                     print(
                         "memory_allocated",
@@ -180,7 +177,7 @@ def evaluate_model(
                         torch.cuda.max_memory_allocated() / 1024**2,
                     )
 
-            ppl = torch.exp(torch.stack(nlls).sum() / (nsamples * lm.seqlen))
+            ppl = torch.exp(nll / count)
             print(dataset, ppl.item())
             lm.model.config.use_cache = use_cache
             # pprint(model)
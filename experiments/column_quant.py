@@ -34,6 +34,7 @@ from quant import (
     BiRealLinear,
     OutliersQLinearColumn,
     BinaryXnorExceptOutliersLinear,
+    calibrate_outliers,
 )
 
 # , FdaBinaryLinear
@@ -122,6 +123,7 @@ def iterative_train(model, ordered_name_modules, data, tokenizer):
     for module_name, module in ordered_name_modules:
         print_trainable_parameters(model)
         replace_qlinear(module, f"{module_name}.")
+        calibrate_outliers(module, sample=args.outlier_sample)
 
         # Define training arguments
         if args.train_steps:
@@ -284,6 +286,12 @@ if __name__ == "__main__":
     parser.add_argument(
         "--outlier_fraction", type=float, default=0.05, help="Percentage of outliers"
     )
+    parser.add_argument(
+        "--outlier_sample",
+        type=int,
+        default=0,
+        help="Estimate outlier thresholds from this many sampled weights per layer (0: exact)",
+    )
     parser.add_argument(
         "--debug", action="store_true", help="Debug mode (only 10 steps)"
     )
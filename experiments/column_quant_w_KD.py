@@ -34,6 +34,7 @@ from quant import (
     BiRealLinear,
     OutliersQLinearColumn,
     BinaryXnorExceptOutliersLinear,
+    calibrate_outliers,
 )
 
 # , FdaBinaryLinear
@@ -45,6 +46,8 @@ from utils import (
     save_bnn,
 )
 from evaluate import evaluate_model
+from gptq_pb.lm_loss import causal_lm_nll, chunked_kl, chunked_topk_kl
+from teacher_cache import teacher_logit_cache
 import torch.nn.functional as F
 
 """
@@ -104,14 +107,16 @@ def replace_qlinear(root_module, name_prefix=""):
             print(f"replace layer {name_prefix}{name} with {qlinear}")
 
 
-def iterative_train(model, teacher_model,ordered_name_modules, data, tokenizer):
+def iterative_train(model, teacher_model,ordered_name_modules, data, tokenizer, teacher_cache=None):
     """
     ordered_name_modules: [(name, module), ...]
+    teacher_cache: TeacherLogitCache used in place of teacher_model
     """
 
     for module_name, module in ordered_name_modules:
         print_trainable_parameters(model)
         replace_qlinear(module, f"{module_name}.")
+        calibrate_outliers(module, sample=args.outlier_sample)
 
         # Define training arguments
         if args.train_steps:
@@ -126,18 +131,29 @@ def iterative_train(model, teacher_model,ordered_name_modules, data, tokenizer):
                 output_dir="outputs",
                 optim="adamw_torch",
                 report_to="tensorboard",
+                # keep the teacher_index column for the cache lookup
+                remove_unused_columns=teacher_cache is None,
             )
 
             # Create trainer
             class Trainer_w_Distiller(Trainer):
-                def __init__(self, *args, teacher_model=None, **kwargs):
+                def __init__(self, *args, teacher_model=None, teacher_cache=None, **kwargs):
                     super().__init__(*args, **kwargs)
 
                     self.teacher = teacher_model
+                    self.teacher_cache = teacher_cache
                     # place teacher on same device as student
                     # self._move_model_to_device(self.teacher, self.model.device)
                     # self.teacher.eval()
 
+                def _prepare_inputs(self, inputs):
+                    # the cache is looked up on the CPU, keep the ids there
+                    ids = inputs.pop("teacher_index", None)
+                    inputs = super()._prepare_inputs(inputs)
+                    if ids is not None:
+                        inputs["teacher_index"] = ids
+                    return inputs
+
                 def kl_loss(self, tensor1, tensor2, temperature=0.5):
                     # student: tensor1, teacher: tensor2
                     tensor1 = F.log_softmax(tensor1 / temperature, dim=-1)
@@ -147,12 +163,69 @@ def iterative_train(model, teacher_model,ordered_name_modules, data, tokenizer):
 
                     return kl_loss
 
+                def compute_loss_chunked(self, model, inputs, temperature=0.5, alpha=0.01):
+                    """
+                    The loss of compute_loss from the final hidden states of both models,
+                    with lm_head, the LM loss and the KD loss run over slices of tokens,
+                    so neither model's [batch, seq, vocab] logits are materialized.
+                    """
+                    labels = inputs.pop("labels")
+                    hidden = model.model(**inputs)[0]
+                    with torch.no_grad():
+                        teacher_hidden = self.teacher.model(**inputs)[0]
+                    nll, count = causal_lm_nll(model.lm_head, hidden, labels)
+                    kd_loss = chunked_kl(
+                        model.lm_head,
+                        hidden.reshape(-1, hidden.shape[-1]),
+                        self.teacher.lm_head,
+                        teacher_hidden.reshape(-1, teacher_hidden.shape[-1]),
+                        temperature,
+                    )
+                    # kl_loss: 'batchmean' and the extra division by the batch size
+                    kd_loss = kd_loss * (temperature**2) / hidden.shape[0] ** 2
+                    return nll / count + alpha * kd_loss
+
+                def compute_loss_cached(self, model, inputs, temperature=0.5, alpha=0.01):
+                    """
+                    compute_loss_chunked with the teacher's top-k logits read from
+                    self.teacher_cache instead of running the teacher.
+                    """
+                    labels = inputs.pop("labels")
+                    ids = inputs.pop("teacher_index").tolist()
+                    hidden = model.model(**inputs)[0]
+                    nll, count = causal_lm_nll(model.lm_head, hidden, labels)
+                    # the cached tokens of each sample are its unpadded positions;
+                    # located from the cached lengths on the CPU, without a sync
+                    batch, seqlen = hidden.shape[:2]
+                    lengths = self.teacher_cache.lengths(ids)
+                    if max(lengths) != seqlen:
+                        raise ValueError("teacher cache does not match the training data")
+                    left = tokenizer.padding_side == "left"
+                    positions = torch.cat([
+                        torch.arange(seqlen - n if left else 0, seqlen if left else n) + j * seqlen
+                        for j, n in enumerate(lengths)
+                    ]).to(hidden.device, non_blocking=True)
+                    values, indices = self.teacher_cache.tokens(ids, hidden.device)
+                    student_hidden = hidden.reshape(batch * seqlen, -1).index_select(0, positions)
+                    kd_loss = chunked_topk_kl(model.lm_head, student_hidden, values, indices, temperature)
+                    # same scale as kl_loss, over the unpadded tokens the cache holds
+                    kd_loss = kd_loss * (temperature**2) / batch**2
+                    return nll / count + alpha * kd_loss
+
                 def compute_loss(self, model, inputs, return_outputs=False):
                     """
                     How the loss is computed by Trainer. By default, all models return the loss in the first element.
 
                     Subclass and override for custom behavior.
                     """
+                    if self.label_smoother is None and "labels" in inputs and not return_outputs:
+                        if self.teacher_cache is not None:
+                            return self.compute_loss_cached(model, inputs)
+                        return self.compute_loss_chunked(model, inputs)
+                    if self.teacher_cache is not None:
+                        raise NotImplementedError(
+                            "the cached teacher only supports the default loss path: labels, no label smoother and no outputs"
+                        )
                     # print(1111111111111111111111111111111111111111111111111111111111111111111)
                     if self.label_smoother is not None and "labels" in inputs:
                         labels = inputs.pop("labels")
@@ -191,6 +264,7 @@ def iterative_train(model, teacher_model,ordered_name_modules, data, tokenizer):
                 model=model,
                 args=training_args,
                 teacher_model=teacher_model,
+                teacher_cache=teacher_cache,
                 train_dataset=data,
                 data_collator=DataCollatorForLanguageModeling(tokenizer, mlm=False),
             )
@@ -235,8 +309,9 @@ def main(args):
         model = LlamaForCausalLM.from_pretrained(args.model_id, device_map="auto")#.to(torch.device("cuda:0"))
         model = prepare_model_for_training(model)
 
-        teacher_model = LlamaForCausalLM.from_pretrained(args.model_id, device_map="auto")#.to(torch.device("cuda:1"))
-        teacher_model = prepare_model_for_training(teacher_model)
+        def load_teacher():
+            teacher_model = LlamaForCausalLM.from_pretrained(args.model_id, device_map="auto")#.to(torch.device("cuda:1"))
+            return prepare_model_for_training(teacher_model)
 
     else:
         tokenizer = AutoTokenizer.from_pretrained(args.model_id, device_map="auto")
@@ -247,15 +322,34 @@ def main(args):
         # model.gradient_checkpointing_enable()
         model = prepare_model_for_training(model)
 
-        teacher_model = AutoModelForCausalLM.from_pretrained(args.model_id, device_map="auto")#.to(torch.device("cuda:1"))
-        teacher_model = prepare_model_for_training(teacher_model)
+        def load_teacher():
+            teacher_model = AutoModelForCausalLM.from_pretrained(args.model_id, device_map="auto")#.to(torch.device("cuda:1"))
+            return prepare_model_for_training(teacher_model)
         # teacher_model = copy.deepcopy(model)
 
     tokenizer.pad_token = tokenizer.eos_token
 
     # Load dataset
     print("prepare training data")
-    data = get_qat_dataset(args.dataset, tokenizer, args.data_percent)
+    if args.teacher_cache:
+        data = get_qat_dataset(args.dataset, tokenizer, args.data_percent, index_column="teacher_index")
+        teacher_cache = teacher_logit_cache(
+            args.teacher_cache,
+            data,
+            load_teacher,
+            k=args.teacher_topk,
+            meta={"model_id": args.model_id, "dataset": args.dataset, "data_percent": args.data_percent},
+        )
+        # the teacher, if it was loaded to build the cache, is freed here
+        teacher_model = None
+        torch.cuda.empty_cache()
+        # with remove_unused_columns off, only what the collator can batch
+        keep = ["input_ids", "attention_mask", "teacher_index"]
+        data = data.remove_columns([c for c in data.column_names if c not in keep])
+    else:
+        data = get_qat_dataset(args.dataset, tokenizer, args.data_percent)
+        teacher_model = load_teacher()
+        teacher_cache = None
 
     if args.granularity == "per_block":
         if isinstance(model, OPTForCausalLM):
@@ -279,7 +373,7 @@ def main(args):
         ordered_name_modules = [("whole_model", model)]
     else:
         raise NotImplementedError
-    iterative_train(model, teacher_model, ordered_name_modules, data, tokenizer)
+    iterative_train(model, teacher_model, ordered_name_modules, data, tokenizer, teacher_cache)
 
 
 if __name__ == "__main__":
@@ -331,6 +425,21 @@ if __name__ == "__main__":
     parser.add_argument(
         "--outlier_fraction", type=float, default=0.05, help="Percentage of outliers"
     )
+    parser.add_argument(
+        "--outlier_sample",
+        type=int,
+        default=0,
+        help="Estimate outlier thresholds from this many sampled weights per layer (0: exact)",
+    )
+    parser.add_argument(
+        "--teacher_cache",
+        type=str,
+        default=None,
+        help="Directory of cached teacher top-k logits, built on first use; the teacher is not run during training",
+    )
+    parser.add_argument(
+        "--teacher_topk", type=int, default=64, help="Number of teacher logits cached per token"
+    )
     parser.add_argument(
         "--debug", action="store_true", help="Debug mode (only 10 steps)"
     )
@@ -0,0 +1,53 @@
+import math
+import os
+
+import torch
+
+
+class ActivationStore:
+    """
+    A (nsamples, seqlen, hidden) activation buffer indexed like a tensor.
+
+    Without `path` the buffer is a dense tensor on `dev` (the previous
+    behaviour). With `path` it is a memory-mapped file and only the samples
+    being indexed are moved to `dev`, so device memory is bounded by the
+    window the caller forwards at a time, not by nsamples.
+    """
+
+    def __init__(self, shape, dtype, dev, path=None):
+        self.shape = torch.Size(shape)
+        self.dtype = dtype
+        self.dev = dev
+        self.path = path
+        if path is None:
+            self.data = torch.zeros(shape, dtype=dtype, device=dev)
+        else:
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            if os.path.exists(path):
+                os.remove(path)
+            self.data = torch.from_file(
+                path, shared=True, size=math.prod(shape), dtype=dtype
+            ).view(shape)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        return self.data[key].to(self.dev)
+
+    def __setitem__(self, key, value):
+        self.data[key] = value
+
+    def like(self, path=None):
+        return ActivationStore(self.shape, self.dtype, self.dev, path)
+
+    def close(self):
+        self.data = None
+        if self.path is not None and os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def offload_path(offload_dir, name):
+    if not offload_dir:
+        return None
+    return os.path.join(offload_dir, name)
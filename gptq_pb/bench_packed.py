@@ -0,0 +1,119 @@
+import argparse
+import time
+
+import torch
+import torch.nn as nn
+
+from high_quant import HighQuantizer
+from low_quant import LowQuantizer
+from pack import pack_linear, packed_bytes
+from packed_linear import PackedPBLinear
+
+
+def fake_quant(W, low_frac, high_bit, groupsize):
+    # RTN version of what LowHighGPT.fasterquant produces, enough for timing
+    low_quantizer = LowQuantizer(W, method="xnor", groupsize=groupsize)
+    high_quantizer = HighQuantizer(high_bit, True, False, False)
+    high_quantizer.calibrate(W, weight=True)
+    saliency = W.abs()
+    thresh = torch.kthvalue(saliency.flatten(), int(saliency.numel() * low_frac)).values
+    mask = saliency <= thresh
+    for groupi in range(low_quantizer.n_groups):
+        st = groupi * low_quantizer.groupsize
+        ed = min(st + low_quantizer.groupsize, W.shape[1])
+        low_quantizer.calibrate(W[:, st:ed] * mask[:, st:ed], mask[:, st:ed], groupi=groupi)
+    Q = torch.empty_like(W)
+    for groupi in range(low_quantizer.n_groups):
+        st = groupi * low_quantizer.groupsize
+        ed = min(st + low_quantizer.groupsize, W.shape[1])
+        Q[:, st:ed] = torch.where(mask[:, st:ed], low_quantizer.quantize(W[:, st:ed], groupi),
+                                  high_quantizer.quantize(W[:, st:ed]))
+    return Q, pack_linear(Q, mask, low_quantizer, high_quantizer)
+
+
+def sync(dev):
+    if dev.type == 'cuda':
+        torch.cuda.synchronize(dev)
+
+
+def bench(fn, x, repeat):
+    fn(x)
+    sync(x.device)
+    tick = time.time()
+    for _ in range(repeat):
+        fn(x)
+    sync(x.device)
+    return (time.time() - tick) / repeat
+
+
+def resident(build, x, dev):
+    # (module, bytes it keeps allocated after a forward, peak bytes during
+    # that forward); on CPU the module's own count of its tensors
+    if dev.type != 'cuda':
+        module = build()
+        module(x)
+        return module, module.resident_bytes(), None
+    sync(dev)
+    base = torch.cuda.memory_allocated(dev)
+    torch.cuda.reset_peak_memory_stats(dev)
+    module = build()
+    module(x)
+    sync(dev)
+    return module, torch.cuda.memory_allocated(dev) - base, torch.cuda.max_memory_allocated(dev) - base
+
+
+def mb(n):
+    return 'n/a' if n is None else f'{n / 2**20:.2f} MB'
+
+
+@torch.no_grad()
+def main(args):
+    torch.manual_seed(0)
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    dev = torch.device(args.device)
+    # fp16 on GPU, fp32 on CPU, as PackedPBLinear computes
+    dtype = torch.float16 if dev.type == 'cuda' else torch.float32
+    W = torch.randn(args.rows, args.columns) * .02
+    Q, packed = fake_quant(W, args.low_frac, args.high_bit, args.groupsize)
+    Q = Q.to(dev, dtype)
+    del W
+    x = torch.randn(max(args.tokens), args.columns, device=dev, dtype=dtype)
+
+    def build_dense():
+        dense = nn.Linear(args.columns, args.rows, bias=False, device=dev, dtype=dtype)
+        dense.weight.data.copy_(Q)
+        return dense
+
+    dense, dense_bytes, dense_peak = resident(build_dense, x, dev)
+    if dev.type != 'cuda':
+        dense_bytes = Q.numel() * Q.element_size()
+    layer, layer_bytes, layer_peak = resident(
+        lambda: PackedPBLinear(packed, tile=args.tile, cache_tiles=not args.no_cache_tiles).to(dev), x, dev)
+    print(f'resident after a forward of {x.shape[0]} tokens: dense {dtype} {mb(dense_bytes)} '
+          f'(peak {mb(dense_peak)}), PackedPBLinear {mb(layer_bytes)} (peak {mb(layer_peak)}), '
+          f'packed file {mb(packed_bytes(packed))}')
+    for tokens in args.tokens:
+        x = torch.randn(tokens, args.columns, device=dev, dtype=dtype)
+        err = (layer(x) - dense(x)).abs().max().item()
+        t_dense = bench(dense, x, args.repeat)
+        t_packed = bench(layer, x, args.repeat)
+        print(f'tokens {tokens}: dense {tokens / t_dense:.1f} tok/s, packed {tokens / t_packed:.1f} tok/s '
+              f'({t_dense / t_packed:.2f}x), max abs diff {err:.2e}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=4096)
+    parser.add_argument('--columns', type=int, default=4096)
+    parser.add_argument('--low_frac', type=float, default=.9)
+    parser.add_argument('--high_bit', type=int, default=8)
+    parser.add_argument('--groupsize', type=int, default=-1)
+    parser.add_argument('--tile', type=int, default=1024)
+    parser.add_argument('--no_cache_tiles', action='store_true')
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--tokens', type=int, nargs='+', default=[1, 16, 128])
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--threads', type=int, default=0)
+    args = parser.parse_args()
+    main(args)
@@ -6,6 +6,8 @@ from datasets import load_dataset
 from transformers import AutoTokenizer, LlamaTokenizer
 import os
 
+from tokenstore import token_store
+
 
 def set_seed(seed):
     np.random.seed(seed)
@@ -25,85 +27,65 @@ def get_tokenizer(model):
         tokenizer = AutoTokenizer.from_pretrained(model, use_fast=False)
     return tokenizer
 
-def get_wikitext2(nsamples, seed, seqlen, model, tokenizer):
-    
-    traindata = load_dataset('wikitext', 'wikitext-2-raw-v1', split='train')
-    testdata = load_dataset('wikitext', 'wikitext-2-raw-v1', split='test')
-
-    trainenc = tokenizer(" ".join(traindata['text']), return_tensors='pt')
-    testenc = tokenizer("\n\n".join(testdata['text']), return_tensors='pt')
+class TokenizerWrapper:
+    def __init__(self, input_ids):
+        self.input_ids = input_ids
 
+def sample_windows(store, nsamples, seed, seqlen):
+    # random seqlen windows of the corpus; documents too short for one are
+    # redrawn, as the per-document sampling of get_c4 always did
     random.seed(seed)
     trainloader = []
     for _ in range(nsamples):
-        i = random.randint(0, trainenc.input_ids.shape[1] - seqlen - 1)
-        j = i + seqlen
-        inp = trainenc.input_ids[:, i:j]
+        d = 0
+        # a single joined document draws no index, like the original sampling
+        while len(store) > 1:
+            d = random.randint(0, len(store) - 1)
+            if store.doc_len(d) > seqlen:
+                break
+        i = random.randint(0, store.doc_len(d) - seqlen - 1)
+        inp = store.window(d, i, i + seqlen)
         tar = inp.clone()
         tar[:, :-1] = -100
         trainloader.append((inp, tar))
-    return trainloader, testenc
+    return trainloader
 
-def get_ptb(nsamples, seed, seqlen, model, tokenizer):
-    traindata = load_dataset('ptb_text_only', 'penn_treebank', split='train')
-    testdata = load_dataset('ptb_text_only', 'penn_treebank', split='test')
+def get_wikitext2(nsamples, seed, seqlen, model, tokenizer):
+    # the splits are tokenized as one joined document each
+    train = token_store(tokenizer, 'wikitext2_train', lambda: [" ".join(
+        load_dataset('wikitext', 'wikitext-2-raw-v1', split='train')['text'])])
+    test = token_store(tokenizer, 'wikitext2_test', lambda: ["\n\n".join(
+        load_dataset('wikitext', 'wikitext-2-raw-v1', split='test')['text'])])
 
-    trainenc = tokenizer(" ".join(traindata['sentence']), return_tensors='pt')
-    testenc = tokenizer(" ".join(testdata['sentence']), return_tensors='pt')
+    trainloader = sample_windows(train, nsamples, seed, seqlen)
+    return trainloader, TokenizerWrapper(test.window(0, 0, test.doc_len(0)))
 
-    random.seed(seed)
-    trainloader = []
-    for _ in range(nsamples):
-        i = random.randint(0, trainenc.input_ids.shape[1] - seqlen - 1)
-        j = i + seqlen
-        inp = trainenc.input_ids[:, i:j]
-        tar = inp.clone()
-        tar[:, :-1] = -100
-        trainloader.append((inp, tar))
-    return trainloader, testenc
+def get_ptb(nsamples, seed, seqlen, model, tokenizer):
+    train = token_store(tokenizer, 'ptb_train', lambda: [" ".join(
+        load_dataset('ptb_text_only', 'penn_treebank', split='train')['sentence'])])
+    test = token_store(tokenizer, 'ptb_test', lambda: [" ".join(
+        load_dataset('ptb_text_only', 'penn_treebank', split='test')['sentence'])])
 
-class TokenizerWrapper:
-    def __init__(self, input_ids):
-        self.input_ids = input_ids
+    trainloader = sample_windows(train, nsamples, seed, seqlen)
+    return trainloader, TokenizerWrapper(test.window(0, 0, test.doc_len(0)))
 
 def get_c4(nsamples, seed, seqlen, model, tokenizer):
-    traindata = load_dataset(
+    # one document per record, so only the lengths are needed to redraw
+    # documents shorter than seqlen
+    train = token_store(tokenizer, 'c4_train00000', lambda: load_dataset(
         'allenai/c4', 'allenai--c4', data_files={'train': 'en/c4-train.00000-of-01024.json.gz'}, split='train'
-    )
-    valdata = load_dataset(
+    )['text'])
+    val = token_store(tokenizer, 'c4_val1100', lambda: [' '.join(load_dataset(
         'allenai/c4', 'allenai--c4', data_files={'validation': 'en/c4-validation.00000-of-00008.json.gz'}, split='validation'
-    )
-
-    random.seed(seed)
-    trainloader = []
-    for _ in range(nsamples):
-        while True:
-            i = random.randint(0, len(traindata) - 1)
-            trainenc = tokenizer(traindata[i]['text'], return_tensors='pt')
-            if trainenc.input_ids.shape[1] > seqlen:
-                break
-        i = random.randint(0, trainenc.input_ids.shape[1] - seqlen - 1)
-        j = i + seqlen
-        inp = trainenc.input_ids[:, i:j]
-        tar = inp.clone()
-        tar[:, :-1] = -100
-        trainloader.append((inp, tar))
-
-    valenc = tokenizer(' '.join(valdata[:1100]['text']), return_tensors='pt')
-    valenc = valenc.input_ids[:, :(256 * seqlen)]
+    )[:1100]['text'])])
 
-    
-    valenc = TokenizerWrapper(valenc)
-
-    return trainloader, valenc
+    trainloader = sample_windows(train, nsamples, seed, seqlen)
+    valenc = val.window(0, 0, min(256 * seqlen, val.doc_len(0)))
+    return trainloader, TokenizerWrapper(valenc)
 
 def get_loaders(name, nsamples=128, seed=0, seqlen=2048, model=''):
-    cache_file=f'cache/{name}_{nsamples}_{seed}_{seqlen}_{model}.pt'
-    try:
-        return torch.load(cache_file)
-    except:
-        pass
-
+    # tokenization is cached per tokenizer and dataset in the token stores,
+    # sampling from them is cheap enough to redo on every call
     tokenizer = get_tokenizer(model)
     
     if 'wikitext2' in name:
@@ -112,9 +94,4 @@ def get_loaders(name, nsamples=128, seed=0, seqlen=2048, model=''):
         loaders= get_ptb(nsamples, seed, seqlen, model, tokenizer)
     if 'c4' in name:
         loaders= get_c4(nsamples, seed, seqlen, model, tokenizer)
-    directory='/'.join(cache_file.split('/')[:-1])
-    if not os.path.exists(directory):
-        os.makedirs(directory)
-
-    torch.save(loaders,cache_file)
     return loaders
@@ -3,112 +3,60 @@ import time
 import torch
 import torch.nn as nn
 
+from modelutils import empty_cache, forward_layer
+from activations import ActivationStore, offload_path
+from lm_loss import window_nll
 
 
-@torch.no_grad()
-def llama_eval(model, testenc, dev,  dataset: str, log_wandb: bool = False):
-    print("Evaluating ...")
-
-    testenc = testenc.input_ids
-    nsamples = testenc.numel() // model.seqlen
-
-    use_cache = model.config.use_cache
-    model.config.use_cache = False
-    layers = model.model.layers
-
-    model.model.embed_tokens = model.model.embed_tokens.to(dev)
-    layers[0] = layers[0].to(dev)
-
-    dtype = next(iter(model.parameters())).dtype
-    inps = torch.zeros(
-        (nsamples, model.seqlen, model.config.hidden_size), dtype=dtype, device=dev
-    )
-    cache = {"i": 0, "attention_mask": None}
-
-    class Catcher(nn.Module):
-        def __init__(self, module):
-            super().__init__()
-            self.module = module
-
-        def forward(self, inp, **kwargs):
-            inps[cache["i"]] = inp
-            cache["i"] += 1
-            cache["attention_mask"] = kwargs["attention_mask"]
-            raise ValueError
-
-    layers[0] = Catcher(layers[0])
-    for i in range(nsamples):
-        batch = testenc[:, (i * model.seqlen) : ((i + 1) * model.seqlen)].to(dev)
-        try:
-            model(batch)
-        except ValueError:
-            pass
-    layers[0] = layers[0].module
-
-    layers[0] = layers[0].cpu()
-    model.model.embed_tokens = model.model.embed_tokens.cpu()
-    torch.cuda.empty_cache()
-
-    outs = torch.zeros_like(inps)
-    attention_mask = cache["attention_mask"]
-
-    for i in range(len(layers)):
-        print(i)
-        layer = layers[i].to(dev)
-
-        for j in range(nsamples):
-            outs[j] = layer(inps[j].unsqueeze(0), attention_mask=attention_mask)[0]
-        layers[i] = layer.cpu()
-        del layer
-        torch.cuda.empty_cache()
-        inps, outs = outs, inps
+def opt_adapter(model):
+    # (blocks, modules before the first block, modules between the last
+    # block and lm_head)
+    decoder = model.model.decoder
+    pre = [decoder.embed_tokens, decoder.embed_positions]
+    if getattr(decoder, 'project_in', None) is not None:
+        pre.append(decoder.project_in)
+    post = [m for m in (decoder.final_layer_norm, getattr(decoder, 'project_out', None)) if m is not None]
+    return decoder.layers, pre, post
 
-    if model.model.norm is not None:
-        model.model.norm = model.model.norm.to(dev)
-    model.lm_head = model.lm_head.to(dev)
 
-    testenc = testenc.to(dev)
-    nlls = []
-    for i in range(nsamples):
-        hidden_states = inps[i].unsqueeze(0)
-        if model.model.norm is not None:
-            hidden_states = model.model.norm(hidden_states)
-        lm_logits = model.lm_head(hidden_states)
-        shift_logits = lm_logits[:, :-1, :].contiguous()
-        shift_labels = testenc[:, (i * model.seqlen) : ((i + 1) * model.seqlen)][:, 1:]
-        loss_fct = nn.CrossEntropyLoss()
-        loss = loss_fct(
-            shift_logits.view(-1, shift_logits.size(-1)), shift_labels.view(-1)
-        )
-        neg_log_likelihood = loss.float() * model.seqlen
-        nlls.append(neg_log_likelihood)
-    ppl = torch.exp(torch.stack(nlls).sum() / (nsamples * model.seqlen))
-    print(f"Perplexity: {ppl.item():3f}")
+def llama_adapter(model):
+    post = [model.model.norm] if model.model.norm is not None else []
+    return model.model.layers, [model.model.embed_tokens], post
 
-    model.config.use_cache = use_cache
 
 @torch.no_grad()
-def opt_eval(model, testenc, dev, dataset: str, log_wandb: bool = False):
+def eval_ppl(model, adapter, testenc, dev, dataset: str, batch_size=1, stride=None,
+             offload_dir=None, chunk=1024):
+    """
+    Perplexity of `model` on `testenc`, one block at a time on `dev`.
+    Windows of model.seqlen tokens start every `stride` tokens (default
+    seqlen, i.e. disjoint windows); every window after the first only scores
+    its last `stride` tokens, which are the ones no earlier window saw.
+    `batch_size` windows are forwarded together, and the lm_head + loss are
+    computed `chunk` tokens at a time. `adapter(model)` locates the blocks
+    and the modules around them, see `opt_adapter`.
+    """
     print('Evaluating ...')
+    tick = time.time()
 
-    testenc = testenc.input_ids
-    nsamples = testenc.numel() // model.seqlen
+    seqlen = model.seqlen
+    stride = stride or seqlen
+    tokens = testenc.input_ids.reshape(-1)
+    starts = list(range(0, tokens.numel() - seqlen + 1, stride))
+    nsamples = len(starts)
 
     use_cache = model.config.use_cache
     model.config.use_cache = False
-    layers = model.model.decoder.layers
-
-    model.model.decoder.embed_tokens = model.model.decoder.embed_tokens.to(dev)
-    model.model.decoder.embed_positions = model.model.decoder.embed_positions.to(dev)
-    if hasattr(model.model.decoder, 'project_out') and model.model.decoder.project_out:
-        model.model.decoder.project_out = model.model.decoder.project_out.to(dev) 
-    if hasattr(model.model.decoder, 'project_in') and model.model.decoder.project_in:
-        model.model.decoder.project_in = model.model.decoder.project_in.to(dev) 
+    layers, pre, post = adapter(model)
+
+    for m in pre:
+        m.to(dev)
     layers[0] = layers[0].to(dev)
 
     dtype = next(iter(model.parameters())).dtype
-    inps = torch.zeros(
-        (nsamples, model.seqlen, model.config.hidden_size), dtype=dtype, device=dev
+    inps = ActivationStore(
+        (nsamples, seqlen, model.config.hidden_size), dtype, dev,
+        offload_path(offload_dir, 'eval_inps.bin')
     )
     cache = {'i': 0, 'attention_mask': None}
 
@@ -116,14 +64,16 @@ def opt_eval(model, testenc, dev, dataset: str, log_wandb: bool = False):
         def __init__(self, module):
             super().__init__()
             self.module = module
+
         def forward(self, inp, **kwargs):
-            inps[cache['i']] = inp
-            cache['i'] += 1
+            inps[cache['i']:cache['i'] + inp.shape[0]] = inp
+            cache['i'] += inp.shape[0]
             cache['attention_mask'] = kwargs['attention_mask']
             raise ValueError
+
     layers[0] = Catcher(layers[0])
-    for i in range(nsamples):
-        batch = testenc[:, (i * model.seqlen):((i + 1) * model.seqlen)].to(dev)
+    for st in range(0, nsamples, batch_size):
+        batch = torch.stack([tokens[b:b + seqlen] for b in starts[st:st + batch_size]]).to(dev)
         try:
             model(batch)
         except ValueError:
@@ -131,53 +81,55 @@ def opt_eval(model, testenc, dev, dataset: str, log_wandb: bool = False):
     layers[0] = layers[0].module
 
     layers[0] = layers[0].cpu()
-    model.model.decoder.embed_tokens = model.model.decoder.embed_tokens.cpu()
-    model.model.decoder.embed_positions = model.model.decoder.embed_positions.cpu()
-    if hasattr(model.model.decoder, 'project_out') and model.model.decoder.project_out:
-        model.model.decoder.project_out = model.model.decoder.project_out.cpu()
-    if hasattr(model.model.decoder, 'project_in') and model.model.decoder.project_in:
-        model.model.decoder.project_in = model.model.decoder.project_in.cpu()
-    torch.cuda.empty_cache()
-
-    outs = torch.zeros_like(inps)
+    for m in pre:
+        m.cpu()
+    empty_cache(dev)
+
+    outs = inps.like(offload_path(offload_dir, 'eval_outs.bin'))
     attention_mask = cache['attention_mask']
 
     for i in range(len(layers)):
         print(i)
         layer = layers[i].to(dev)
 
-        for j in range(nsamples):
-            outs[j] = layer(inps[j].unsqueeze(0), attention_mask=attention_mask)[0]
+        forward_layer(layer, inps, outs, nsamples, attention_mask, batch_size)
         layers[i] = layer.cpu()
         del layer
-        torch.cuda.empty_cache()
+        empty_cache(dev)
         inps, outs = outs, inps
 
-    if model.model.decoder.final_layer_norm is not None:
-        model.model.decoder.final_layer_norm = model.model.decoder.final_layer_norm.to(dev)
-    if model.model.decoder.project_out is not None:
-        model.model.decoder.project_out = model.model.decoder.project_out.to(dev)
+    for m in post:
+        m.to(dev)
     model.lm_head = model.lm_head.to(dev)
 
-    testenc = testenc.to(dev)
-    nlls = []
-    for i in range(nsamples):
-        hidden_states = inps[i].unsqueeze(0)
-        if model.model.decoder.final_layer_norm is not None:
-            hidden_states = model.model.decoder.final_layer_norm(hidden_states)
-        if model.model.decoder.project_out is not None:
-            hidden_states = model.model.decoder.project_out(hidden_states)
-        lm_logits = model.lm_head(hidden_states)
-        shift_logits = lm_logits[:, :-1, :].contiguous()
-        shift_labels = testenc[
-            :, (i * model.seqlen):((i + 1) * model.seqlen)
-        ][:, 1:]
-        loss_fct = nn.CrossEntropyLoss()
-        loss = loss_fct(shift_logits.view(-1, shift_logits.size(-1)), shift_labels.view(-1))
-        neg_log_likelihood = loss.float() * model.seqlen
-        nlls.append(neg_log_likelihood)
-    ppl = torch.exp(torch.stack(nlls).sum() / (nsamples * model.seqlen))
+    tokens = tokens.to(dev)
+    nll = torch.zeros((), dtype=torch.float64, device=dev)
+    count = 0
+    for st in range(0, nsamples, batch_size):
+        ed = min(st + batch_size, nsamples)
+        hidden_states = inps[st:ed]
+        for m in post:
+            hidden_states = m(hidden_states)
+        batch_nll, batch_count = window_nll(model.lm_head, hidden_states, tokens, starts[st:ed],
+                                            seqlen, stride, chunk)
+        nll += batch_nll
+        count += batch_count
+    ppl = torch.exp(nll / count)
     print(f"Perplexity: {ppl.item():3f}")
     print({f'{dataset}/perplexity': ppl.item()})
+    print('eval time %.2f' % (time.time() - tick))
+
+    inps.close()
+    outs.close()
+    model.config.use_cache = use_cache
+    return ppl.item()
+
+
+def llama_eval(model, testenc, dev, dataset: str, log_wandb: bool = False, offload_dir=None, micro_batch=1,
+               stride=None):
+    return eval_ppl(model, llama_adapter, testenc, dev, dataset, micro_batch, stride, offload_dir)
+
 
-    model.config.use_cache = use_cache
\ No newline at end of file
+def opt_eval(model, testenc, dev, dataset: str, log_wandb: bool = False, offload_dir=None, micro_batch=1,
+             stride=None):
+    return eval_ppl(model, opt_adapter, testenc, dev, dataset, micro_batch, stride, offload_dir)
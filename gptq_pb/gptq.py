@@ -1,10 +1,15 @@
 import math
+import threading
 import time
 
 import torch
 import torch.nn as nn
 import transformers
 
+from modelutils import sync, empty_cache
+from pack import pack_linear, quant_bits, zero_dtype
+from salient import salient_mask
+
 DEBUG = False 
 # DEBUG = True
 
@@ -12,9 +17,152 @@ torch.backends.cuda.matmul.allow_tf32 = False
 torch.backends.cudnn.allow_tf32 = False
 
 
+def inverse_cholesky(H):
+    """
+    Upper Cholesky factor U of H^-1 (H^-1 = U^T U), as used by the GPTQ sweep.
+    """
+    if H.device.type == 'cuda':
+        H = torch.linalg.cholesky(H)
+        H = torch.cholesky_inverse(H)
+        return torch.linalg.cholesky(H, upper=True)
+    # On CPU the three LAPACK calls dominate: factor the reversed matrix
+    # J H J = L L^T once, then U = J L^-1 J is a single triangular solve.
+    L = torch.linalg.cholesky(H.flip(0, 1))
+    eye = torch.eye(H.shape[0], dtype=H.dtype, device=H.device)
+    Linv = torch.linalg.solve_triangular(L, eye, upper=False)
+    return Linv.flip(0, 1)
+
+
+class HessianAccumulator:
+    """
+    Accumulates H = 2/n * sum(X X^T) over calibration batches.
+
+    With token_budget=0 every batch rescales and updates H in fp32 right away
+    (the original behaviour). Otherwise inputs are buffered in their own dtype
+    until token_budget tokens are pending, then folded in with one blocked
+    rank-k update of the upper triangle; the 2/n normalization and the
+    symmetrization are applied once in `finalize`.
+
+    H is allocated on the first batch, so accumulators of sublayers that end
+    up sharing another one's Hessian (see HessianRegistry) never hold a
+    d x d matrix.
+    """
+
+    def __init__(self, columns, dev, token_budget=0, blocksize=1024):
+        self.columns = columns
+        self.dev = dev
+        self.token_budget = token_budget
+        self.blocksize = blocksize
+        self.H = None
+        self.nsamples = 0
+        self.buffer = []
+        self.buffered = 0
+        self.factor = None
+        self.hdiag = None
+        self.lock = threading.Lock()
+
+    def alloc(self):
+        if self.H is None:
+            self.H = torch.zeros((self.columns, self.columns), device=self.dev)
+        return self.H
+
+    def add_batch(self, inp, tmp):
+        # inp: [columns, tokens], tmp: number of samples in the batch
+        self.alloc()
+        if not self.token_budget:
+            self.H *= self.nsamples / (self.nsamples + tmp)
+            self.nsamples += tmp
+            inp = math.sqrt(2 / self.nsamples) * inp.float()
+            self.H += inp.matmul(inp.t())
+            return
+        self.nsamples += tmp
+        self.buffer.append(inp)
+        self.buffered += inp.shape[1]
+        if self.buffered >= self.token_budget:
+            self.flush()
+
+    def flush(self):
+        if not self.buffer:
+            return
+        X = torch.cat(self.buffer, 1).float()
+        self.buffer = []
+        self.buffered = 0
+        for st in range(0, self.columns, self.blocksize):
+            ed = min(st + self.blocksize, self.columns)
+            self.H[st:ed, st:].addmm_(X[st:ed], X[st:].t())
+
+    def finalize(self):
+        self.flush()
+        H = self.alloc()
+        self.H = None
+        if self.token_budget:
+            H.triu_()
+            H += H.triu(1).t()
+            H *= 2 / self.nsamples
+        return H
+
+    def factorize(self, percdamp=.01, act_order=False):
+        """
+        Returns (Hinv, dead, perm): the upper Cholesky factor of the dampened
+        inverse Hessian, the mask of dead input columns and, with
+        `act_order`, the column order by descending Hessian diagonal that
+        Hinv (and `hdiag`) is expressed in (None otherwise). Computed once and
+        shared by every LowHighGPT holding this accumulator.
+        """
+        with self.lock:
+            if self.factor is None:
+                H = self.finalize()
+                dead = torch.diag(H) == 0
+                H[dead, dead] = 1
+                perm = None
+                if act_order:
+                    perm = torch.argsort(torch.diag(H), descending=True)
+                    H = H[perm][:, perm]
+                damp = percdamp * torch.mean(torch.diag(H))
+                diag = torch.arange(self.columns, device=self.dev)
+                H[diag, diag] += damp
+                self.hdiag = torch.diag(H).clone()
+                self.factor = (inverse_cholesky(H), dead, perm)
+            elif (self.factor[2] is not None) != act_order:
+                raise NotImplementedError("a shared Hessian is factorized for one column order only")
+            return self.factor
+
+
+class HessianRegistry:
+    """
+    Shares one HessianAccumulator between sublayers that consume the same
+    input tensor (q/k/v_proj, fc1 after the same layernorm, gate/up_proj).
+    Inputs are keyed by tensor identity; the tensors are kept alive until
+    `step()` so their ids cannot be reused within one forward pass. Call
+    `step()` after every forward of the block.
+    """
+
+    def __init__(self):
+        self.live = {}
+        self.groups = {}
+
+    def add_batch(self, name, gpt, inp, out):
+        key = id(inp)
+        if key in self.live:
+            owner, hessian = self.live[key][1:]
+            if gpt.hessian is not hessian:
+                gpt.hessian = hessian
+                self.groups.setdefault(owner, [owner]).append(name)
+            return
+        self.live[key] = (inp, name, gpt.hessian)
+        gpt.add_batch(inp.data, out.data)
+
+    def step(self):
+        self.live = {}
+
+    def report(self):
+        for names in self.groups.values():
+            print('shared hessian:', ', '.join(names))
+
+
 class LowHighGPT:
 
-    def __init__(self, layer,low_quantizer,high_quantizer, salient_metric, disable_gptq=False):
+    def __init__(self, layer,low_quantizer,high_quantizer, salient_metric, disable_gptq=False, token_budget=0):
         self.layer = layer
         self.dev = self.layer.weight.device
         W = layer.weight.data.clone()
@@ -24,8 +172,7 @@ class LowHighGPT:
             W = W.t()
         self.rows = W.shape[0]
         self.columns = W.shape[1]
-        self.H = torch.zeros((self.columns, self.columns), device=self.dev)
-        self.nsamples = 0
+        self.hessian = HessianAccumulator(self.columns, self.dev, token_budget=token_budget)
         self.low_quantizer=low_quantizer
         self.high_quantizer=high_quantizer
         self.salient_metric=salient_metric # "magnitude" or "hessian"
@@ -42,14 +189,12 @@ class LowHighGPT:
             if len(inp.shape) == 3:
                 inp = inp.reshape((-1, inp.shape[-1]))
             inp = inp.t()
-        self.H *= self.nsamples / (self.nsamples + tmp)
-        self.nsamples += tmp
-        inp = math.sqrt(2 / self.nsamples) * inp.float()
-        self.H += inp.matmul(inp.t())
+        self.hessian.add_batch(inp, tmp)
         # breakpoint()
 
     def fasterquant(
-        self, low_frac, blocksize=128, percdamp=.01
+        self, low_frac, blocksize=128, percdamp=.01, solver="column", compare_solver=False,
+        pack=False, salient_sample=0, groupwise=False, act_order=False,
     ):
         W = self.layer.weight.data.clone()
         if isinstance(self.layer, nn.Conv2d):
@@ -58,132 +203,253 @@ class LowHighGPT:
             W = W.t()
         W = W.float()
 
-        if not self.high_quantizer.ready():
+        if not groupwise and not self.high_quantizer.ready():
             self.high_quantizer.calibrate(W, weight=True)
 
         tick = time.time()
 
-        H = self.H
-        del self.H
-        dead = torch.diag(H) == 0
-        H[dead, dead] = 1
+        Hinv, dead, perm = self.hessian.factorize(percdamp, act_order)
         W[:, dead] = 0
-
-        Losses = torch.zeros(self.rows, device=self.dev)
-
-        damp = percdamp * torch.mean(torch.diag(H))
-        diag = torch.arange(self.columns, device=self.dev)
-        H[diag, diag] += damp
-        H = torch.linalg.cholesky(H)
-        H = torch.cholesky_inverse(H)
-        H = torch.linalg.cholesky(H, upper=True)
-        Hinv = H
-        mask = None
-        mask=torch.zeros_like(W,dtype=torch.bool)
-        for groupi in range(self.low_quantizer.n_groups):
-            st=groupi*self.low_quantizer.groupsize
-            ed=min(st+self.low_quantizer.groupsize,self.columns)
-            if self.salient_metric=="magnitude":
-                saliency=torch.abs(W[:,st:ed])
-                thresh = torch.sort(saliency.flatten())[0][int(saliency.numel() * low_frac)]
-                mask[:,st:ed] = saliency <= thresh
-            elif self.salient_metric=="hessian":
-                tmp = W[:,st:ed] ** 2 / (torch.diag(H[st:ed,st:ed]).reshape((1, -1))) ** 2
-                thresh = torch.sort(tmp.flatten())[0][int(tmp.numel() * low_frac)]
-                mask[:,st:ed] = tmp <= thresh
-            else:
-                raise NotImplementedError
+        if act_order:
+            # everything below, groups included, works in the permuted order
+            W = W[:, perm]
+        if not groupwise:
             assert self.low_quantizer.groupsize%blocksize==0
-            self.low_quantizer.calibrate(W[:,st:ed]*mask[:,st:ed],mask[:,st:ed],groupi=groupi)
-            # self.low_quantizer.calibrate(W[:,st:ed],mask[:,st:ed],groupi=groupi)
-        
-            
-            
+        mask = salient_mask(W, self.low_quantizer.groupsize, low_frac, self.salient_metric, Hinv, salient_sample)
+        salient_frac = 1 - mask.float().mean().item()
+        print('salient fraction %.4f' % salient_frac)
+        fit_groups = self.low_quantizer.method=="xnor" and self.low_quantizer.calib!="heuristic"
+        if groupwise:
+            # both quantizers are calibrated group by group inside the sweep
+            fit_groups = False
+            self.high_groups = {}
+        elif fit_groups:
+            hdiag = self.hessian.hdiag if self.low_quantizer.calib_hessian else None
+            low_error, low_error_heuristic = self.low_quantizer.calibrate_groups(W, mask, hdiag)
+            print('xnor %s fit: error %.4f (heuristic %.4f)' % (
+                self.low_quantizer.calib, low_error, low_error_heuristic))
+        else:
+            for groupi in range(self.low_quantizer.n_groups):
+                st=groupi*self.low_quantizer.groupsize
+                ed=min(st+self.low_quantizer.groupsize,self.columns)
+                self.low_quantizer.calibrate(W[:,st:ed]*mask[:,st:ed],mask[:,st:ed],groupi=groupi)
+                # self.low_quantizer.calibrate(W[:,st:ed],mask[:,st:ed],groupi=groupi)
 
-        for blocki,col_st in enumerate(range(0, self.columns, blocksize)):
-            col_ed = min(col_st + blocksize, self.columns)
-            n_cols = col_ed - col_st
-            if self.disable_gptq:
-                # RTN
-                # print("RTN")
-                w=W[:, col_st:col_ed]
-                q_high = self.high_quantizer.quantize(
-                w
-                )
-                groupi=col_st//self.low_quantizer.groupsize
-                q_low = self.low_quantizer.quantize(
-                    w,groupi
-                )
-                q=q_high*~mask[:, col_st:col_ed]+q_low*mask[:, col_st:col_ed]
-                W[:, col_st:col_ed]=q
-            else:
-                # shape of W1: [oc, n_cols]
-                W1 = W[:, col_st:col_ed].clone()
-                Q1 = torch.zeros_like(W1)
-                Err1 = torch.zeros_like(W1)
-                Losses1 = torch.zeros_like(W1)
-                Hinv1 = Hinv[col_st:col_ed, col_st:col_ed]
-
-                
-
-                if mask is not None:
-                    mask1 = mask[:, col_st:col_ed]
-                else:
-                    tmp = W1 ** 2 / (torch.diag(Hinv1).reshape((1, -1))) ** 2
-                    # TODO: use torch.kthvalue
-                    thresh = torch.sort(tmp.flatten())[0][int(tmp.numel() * low_frac)]
-                    mask1 = tmp <= thresh
-                
-
-                for i in range(n_cols):
-                    # shape of w: [oc, 1]
-                    w = W1[:, i]
-                    d = Hinv1[i, i]
-
-                    q_high = self.high_quantizer.quantize(
-                        w.unsqueeze(1)
-                    ).flatten()
-                    # TODO: support groupsize>1
-                    groupi=col_st//self.low_quantizer.groupsize
-                    q_low = self.low_quantizer.quantize(
-                        w.unsqueeze(1),groupi
-                    ).flatten()
-                    q=q_high*~mask1[:, i]+q_low*mask1[:, i]
-
-                    Q1[:, i] = q
-                    Losses1[:, i] = (w - q) ** 2 / d ** 2
-                    # breakpoint()
-
-                    err1 = (w - q) / d
-                    W1[:, i:] -= err1.unsqueeze(1).matmul(Hinv1[i, i:].unsqueeze(0))
-                    Err1[:, i] = err1
-
-                W[:, col_st:col_ed] = Q1
-                Losses += torch.sum(Losses1, 1) / 2
-
-                W[:, col_ed:] -= Err1.matmul(Hinv[col_st:col_ed, col_ed:])
-
-                if DEBUG:
-                    self.layer.weight.data[:, :col_ed] = W[:, :col_ed]
-                    self.layer.weight.data[:, col_ed:] = W[:, col_ed:]
-                    print(torch.sum((self.layer(self.inp1) - self.out1) ** 2))
-                    print(torch.sum(Losses))
-            
-
-        torch.cuda.synchronize()
+        if self.disable_gptq:
+            sweep = self.sweep_rtn
+        elif solver == "lazy":
+            sweep = self.sweep_lazy
+        elif solver == "column":
+            sweep = self.sweep_column
+        else:
+            raise NotImplementedError(f"solver {solver} not implemented")
+        if compare_solver and not self.disable_gptq:
+            W_ref = W.clone()
+
+        sweep_tick = time.time()
+        W, Losses = sweep(W, Hinv, mask, blocksize, low_frac, groupwise)
+        sync(self.dev)
+        sweep_time = time.time() - sweep_tick
         print('time %.2f' % (time.time() - tick))
         print('error', torch.sum(Losses).item())
 
+        info = {"error": torch.sum(Losses).item(), "time": sweep_time, "salient_frac": salient_frac}
+        if fit_groups:
+            info["low_error"] = low_error
+            info["low_error_heuristic"] = low_error_heuristic
+        if compare_solver and not self.disable_gptq:
+            # the reference sweep recalibrates groups too; keep the state of
+            # the sweep whose weights are returned (and packed)
+            state = self.group_state()
+            ref_tick = time.time()
+            W_ref, Losses_ref = self.sweep_column(W_ref, Hinv, mask, blocksize, low_frac, groupwise)
+            sync(self.dev)
+            self.set_group_state(state)
+            ref_time = time.time() - ref_tick
+            info["max_diff"] = (W - W_ref).abs().max().item()
+            info["speedup"] = ref_time / max(sweep_time, 1e-9)
+            print('solver %s vs column: max diff %.3e, speedup %.2fx (%.2fs vs %.2fs)' % (
+                solver, info["max_diff"], info["speedup"], sweep_time, ref_time))
+            del W_ref
+
+        if pack:
+            self.packed = pack_linear(W, mask, self.low_quantizer, self.high_quantizer,
+                                      self.high_groups if groupwise else None, perm)
+        if act_order:
+            W = W[:, torch.argsort(perm)]
+
         if isinstance(self.layer, transformers.Conv1D):
             W = W.t()
         self.layer.weight.data = W.reshape(self.layer.weight.shape).to(self.layer.weight.data.dtype)
         if DEBUG:
             print(torch.sum((self.layer(self.inp1) - self.out1) ** 2))
-        return {"error":torch.sum(Losses).item()}
+        return info
+
+    def group_state(self):
+        # quantizer parameters that the sweeps may recalibrate
+        buffers = [{k: v.clone() for k, v in q._buffers.items() if v is not None}
+                   for q in (self.high_quantizer, self.low_quantizer)]
+        return dict(getattr(self, 'high_groups', {})), buffers
+
+    def set_group_state(self, state):
+        self.high_groups, buffers = state
+        for q, saved in zip((self.high_quantizer, self.low_quantizer), buffers):
+            for k, v in saved.items():
+                setattr(q, k, v)
+
+    def calibrate_group(self, W, W1, mask, col_st, i):
+        """
+        Groupwise mode: recalibrate both quantizers for the group starting at
+        column col_st + i, on its current weights, i.e. the updated tail of
+        the block W1 followed by the columns of W past the block, which have
+        not received this block's lazy update yet (as in GPTQ). Scales are
+        rounded to fp16 so that the packed parameters (fp16 scales, integer
+        zeros sized to the bit width) reproduce the quantized weights exactly.
+        """
+        groupsize = self.low_quantizer.groupsize
+        g_st = col_st + i
+        g_ed = min(g_st + groupsize, self.columns)
+        col_ed = col_st + W1.shape[1]
+        groupi = g_st // groupsize
+        Wg = torch.cat([W1[:, i:g_ed - col_st], W[:, col_ed:g_ed]], 1)
+        maskg = mask[:, g_st:g_ed]
+
+        self.high_quantizer.calibrate(Wg, weight=True)
+        self.high_quantizer.scale = self.high_quantizer.scale.half().float()
+        self.high_groups[groupi] = (self.high_quantizer.scale.flatten().half(),
+                                    self.high_quantizer.zero.flatten().to(zero_dtype(quant_bits(self.high_quantizer))))
+
+        low = self.low_quantizer
+        if low.method == "xnor" and low.calib != "heuristic":
+            hdiag = self.hessian.hdiag[g_st:g_ed] if low.calib_hessian else None
+            low.calibrate_groups(Wg, maskg, hdiag, groupi)
+        else:
+            low.calibrate(Wg * maskg, maskg, groupi=groupi)
+        low.scale = low.scale.to(self.dev)
+        low.mean = low.mean.to(self.dev)
+        low.scale[groupi] = low.scale[groupi].half().float()
+        low.mean[groupi] = low.mean[groupi].half().float()
+
+    def sweep_rtn(self, W, Hinv, mask, blocksize, low_frac, groupwise=False):
+        Losses = torch.zeros(self.rows, device=self.dev)
+        if groupwise:
+            blocksize = self.low_quantizer.groupsize
+        for blocki,col_st in enumerate(range(0, self.columns, blocksize)):
+            col_ed = min(col_st + blocksize, self.columns)
+            if groupwise:
+                self.calibrate_group(W, W[:, col_st:col_ed], mask, col_st, 0)
+            # RTN
+            # print("RTN")
+            w=W[:, col_st:col_ed]
+            q_high = self.high_quantizer.quantize(
+            w
+            )
+            groupi=col_st//self.low_quantizer.groupsize
+            q_low = self.low_quantizer.quantize(
+                w,groupi
+            )
+            q=q_high*~mask[:, col_st:col_ed]+q_low*mask[:, col_st:col_ed]
+            W[:, col_st:col_ed]=q
+        return W, Losses
+
+    def sweep_column(self, W, Hinv, mask, blocksize, low_frac, groupwise=False):
+        Losses = torch.zeros(self.rows, device=self.dev)
+        for blocki,col_st in enumerate(range(0, self.columns, blocksize)):
+            col_ed = min(col_st + blocksize, self.columns)
+            n_cols = col_ed - col_st
+            # shape of W1: [oc, n_cols]
+            W1 = W[:, col_st:col_ed].clone()
+            Q1 = torch.zeros_like(W1)
+            Err1 = torch.zeros_like(W1)
+            Losses1 = torch.zeros_like(W1)
+            Hinv1 = Hinv[col_st:col_ed, col_st:col_ed]
+
+            mask1 = mask[:, col_st:col_ed]
+
+            for i in range(n_cols):
+                # shape of w: [oc, 1]
+                w = W1[:, i]
+                d = Hinv1[i, i]
+                groupi = (col_st + i) // self.low_quantizer.groupsize
+                if groupwise and (col_st + i) % self.low_quantizer.groupsize == 0:
+                    self.calibrate_group(W, W1, mask, col_st, i)
+
+                q_high = self.high_quantizer.quantize(
+                    w.unsqueeze(1)
+                ).flatten()
+                q_low = self.low_quantizer.quantize(
+                    w.unsqueeze(1),groupi
+                ).flatten()
+                q=q_high*~mask1[:, i]+q_low*mask1[:, i]
+
+                Q1[:, i] = q
+                Losses1[:, i] = (w - q) ** 2 / d ** 2
+                # breakpoint()
+
+                err1 = (w - q) / d
+                W1[:, i:] -= err1.unsqueeze(1).matmul(Hinv1[i, i:].unsqueeze(0))
+                Err1[:, i] = err1
+
+            W[:, col_st:col_ed] = Q1
+            Losses += torch.sum(Losses1, 1) / 2
+
+            W[:, col_ed:] -= Err1.matmul(Hinv[col_st:col_ed, col_ed:])
+
+            if DEBUG:
+                self.layer.weight.data[:, :col_ed] = W[:, :col_ed]
+                self.layer.weight.data[:, col_ed:] = W[:, col_ed:]
+                print(torch.sum((self.layer(self.inp1) - self.out1) ** 2))
+                print(torch.sum(Losses))
+        return W, Losses
+
+    def sweep_lazy(self, W, Hinv, mask, blocksize, low_frac, groupwise=False):
+        """
+        Same recursion as `sweep_column`, but the quantizer parameters of each
+        block are bound once (no per-column dispatch, device checks or
+        `ready()` syncs), the rank-1 updates run in place and the losses are
+        reduced once per block from the scaled errors.
+        """
+        Losses = torch.zeros(self.rows, device=self.dev)
+        quant_high = self.high_quantizer.quantize_fn()
+        for col_st in range(0, self.columns, blocksize):
+            col_ed = min(col_st + blocksize, self.columns)
+            n_cols = col_ed - col_st
+            W1 = W[:, col_st:col_ed].clone()
+            Q1 = torch.zeros_like(W1)
+            Err1 = torch.zeros_like(W1)
+            Hinv1 = Hinv[col_st:col_ed, col_st:col_ed]
+            d1 = torch.diag(Hinv1)
+            mask1 = mask[:, col_st:col_ed]
+            groupi = col_st // self.low_quantizer.groupsize
+            quant_low = self.low_quantizer.quantize_fn(groupi, self.dev)
+
+            for i in range(n_cols):
+                if groupwise and (col_st + i) % self.low_quantizer.groupsize == 0:
+                    self.calibrate_group(W, W1, mask, col_st, i)
+                    quant_high = self.high_quantizer.quantize_fn()
+                    quant_low = self.low_quantizer.quantize_fn((col_st + i) // self.low_quantizer.groupsize, self.dev)
+                # shape of w: [oc, 1]
+                w = W1[:, i:i + 1]
+                q = torch.where(mask1[:, i:i + 1], quant_low(w), quant_high(w))
+                Q1[:, i:i + 1] = q
+                err1 = (w - q).div_(d1[i])
+                Err1[:, i:i + 1] = err1
+                W1[:, i:].addmm_(err1, Hinv1[i:i + 1, i:], alpha=-1)
+
+            W[:, col_st:col_ed] = Q1
+            Losses += torch.sum(Err1 ** 2, 1) / 2
+            W[:, col_ed:].addmm_(Err1, Hinv[col_st:col_ed, col_ed:], alpha=-1)
+        return W, Losses
+
+    def quant_memory(self, blocksize=128):
+        # rough peak bytes of fasterquant: fp32 W (+ clone for the result),
+        # the bool mask, H and its Cholesky factor, and the block buffers
+        return (4 * 2 * self.rows * self.columns + self.rows * self.columns
+                + 4 * 3 * self.columns * self.columns + 4 * 4 * self.rows * blocksize)
 
     def free(self):
         if DEBUG:
             self.inp1 = None
             self.out1 = None
-        self.H = None
-        torch.cuda.empty_cache()
+        self.hessian = None
+        empty_cache(self.dev)
@@ -11,7 +11,7 @@ class HighQuantizer(nn.Module):
 
     def __init__(self, bits, perchannel=False, sym=True, 
             mse=False, norm=2.4, grid=100, maxshrink=.8,
-            grouprows=1,shape=1):
+            grouprows=1,shape=1, mse_chunk=2**26, mse_refine=0):
         super().__init__()
         self.register_buffer('maxq', torch.tensor(0))
         self.register_buffer('scale', torch.zeros(shape))
@@ -24,6 +24,8 @@ class HighQuantizer(nn.Module):
         self.grid = grid
         self.maxshrink = maxshrink 
         self.grouprows = grouprows
+        self.mse_chunk = mse_chunk # max elements of one batched candidate evaluation
+        self.mse_refine = mse_refine # >1: coarse grid with this stride, then refine around the best
         
 
     def calibrate(self, x, weight=False):
@@ -67,23 +69,22 @@ class HighQuantizer(nn.Module):
             self.zero = torch.round(-xmin / self.scale)
 
         if self.mse:
-            best = torch.full([x.shape[0]], float('inf'), device=dev)
-            for i in range(int(self.maxshrink * self.grid)):
-                p = 1 - i / self.grid 
-                xmin1 = p * xmin
-                xmax1 = p * xmax
-                scale1 = (xmax1 - xmin1) / self.maxq
-                zero1 = torch.round(-xmin1 / scale1) if not self.sym else self.zero
-                q = quantize(x, scale1.unsqueeze(1), zero1.unsqueeze(1), self.maxq)
-                q -= x
-                q.abs_()
-                q.pow_(self.norm)
-                err = torch.sum(q, 1)
-                tmp = err < best
-                if torch.any(tmp):
-                    best[tmp] = err[tmp]
-                    self.scale[tmp] = scale1[tmp]
-                    self.zero[tmp] = zero1[tmp]
+            steps = int(self.maxshrink * self.grid)
+            if self.mse_refine > 1:
+                idx = torch.arange(0, steps, self.mse_refine, device=dev)
+                idx = idx.unsqueeze(1).expand(-1, x.shape[0])
+                best = self.grid_search(x, xmin, xmax, idx)
+                offsets = torch.arange(1 - self.mse_refine, self.mse_refine, device=dev)
+                idx = torch.clamp(best.unsqueeze(0) + offsets.unsqueeze(1), 0, steps - 1)
+            else:
+                idx = torch.arange(steps, device=dev).unsqueeze(1).expand(-1, x.shape[0])
+            best = self.grid_search(x, xmin, xmax, idx)
+            p = 1 - best.float() / self.grid
+            xmin1 = p * xmin
+            xmax1 = p * xmax
+            self.scale = (xmax1 - xmin1) / self.maxq
+            if not self.sym:
+                self.zero = torch.round(-xmin1 / self.scale)
         if not self.perchannel:
             if weight:
                 tmp = shape[0]
@@ -110,11 +111,49 @@ class HighQuantizer(nn.Module):
             self.scale = self.scale.unsqueeze(0)
             self.zero = self.zero.unsqueeze(0)
 
+    def grid_search(self, x, xmin, xmax, idx):
+        """
+        Evaluate the shrink candidates `idx` [k, rows] (grid steps, per row)
+        and return the best step of every row. Candidates and rows are
+        processed in chunks of at most `mse_chunk` quantized elements; ties
+        go to the earlier candidate, as in the sequential search.
+        """
+        p = 1 - idx.float() / self.grid
+        xmin1 = p * xmin
+        xmax1 = p * xmax
+        scale1 = (xmax1 - xmin1) / self.maxq
+        zero1 = torch.round(-xmin1 / scale1) if not self.sym else self.zero.expand_as(scale1)
+        k, rows = idx.shape
+        columns = x.shape[1]
+        err = torch.empty(k, rows, device=x.device)
+        kc = max(1, min(k, self.mse_chunk // columns))
+        for c0 in range(0, k, kc):
+            c1 = min(c0 + kc, k)
+            rc = max(1, self.mse_chunk // ((c1 - c0) * columns))
+            for r0 in range(0, rows, rc):
+                r1 = min(r0 + rc, rows)
+                q = quantize(
+                    x[r0:r1].unsqueeze(0),
+                    scale1[c0:c1, r0:r1].unsqueeze(2), zero1[c0:c1, r0:r1].unsqueeze(2), self.maxq
+                )
+                q -= x[r0:r1]
+                q.abs_()
+                q.pow_(self.norm)
+                err[c0:c1, r0:r1] = torch.sum(q, 2)
+        return idx.gather(0, err.argmin(0, keepdim=True)).squeeze(0)
+
     def quantize(self, x, blocki=None):
         if self.ready():
             return quantize(x, self.scale, self.zero, self.maxq)
         return x
 
+    def quantize_fn(self):
+        # bind the calibrated parameters once, for the per-column solver loop
+        if not self.ready():
+            return lambda x: x
+        scale, zero, maxq = self.scale, self.zero, self.maxq
+        return lambda x: quantize(x, scale, zero, maxq)
+
     def enabled(self):
         return self.maxq > 0
 
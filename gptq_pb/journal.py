@@ -0,0 +1,62 @@
+import json
+import os
+
+import torch
+
+
+class QuantJournal:
+    """
+    On-disk journal for `quant_sequential`: after every block it stores the
+    block's quantized state dict and the activations feeding the next block,
+    then atomically bumps `meta.json`. `key` is the run configuration (a
+    JSON-serializable dict); resuming a journal written under a different
+    configuration is refused, since it would stitch together blocks
+    quantized with different settings.
+    """
+
+    def __init__(self, path, key):
+        self.path = path
+        self.key = key
+        os.makedirs(path, exist_ok=True)
+        self.done = -1
+        meta_file = os.path.join(path, 'meta.json')
+        if os.path.exists(meta_file):
+            meta = json.load(open(meta_file))
+            if meta['key'] != key:
+                diff = sorted(k for k in set(key) | set(meta['key']) if key.get(k) != meta['key'].get(k))
+                raise ValueError(
+                    f'journal {path} was written with different settings ({", ".join(diff)}), '
+                    'use another journal directory or remove it'
+                )
+            self.done = meta['done']
+
+    def file(self, name):
+        return os.path.join(self.path, name)
+
+    def save(self, obj, name):
+        # write-then-rename so a crash never leaves a truncated file behind
+        torch.save(obj, self.file(name + '.tmp'))
+        os.replace(self.file(name + '.tmp'), self.file(name))
+
+    def commit(self, i, layer, inps, attention_mask, extra, packed=None):
+        self.save({'state_dict': layer.state_dict(), 'packed': packed}, f'layer_{i}.pt')
+        # `.data` is the backing tensor of an ActivationStore (and the tensor itself otherwise)
+        self.save({'inps': inps.data, 'attention_mask': attention_mask, 'extra': extra}, f'inps_{i}.pt')
+        with open(self.file('meta.json.tmp'), 'w') as f:
+            json.dump({'key': self.key, 'done': i}, f)
+        os.replace(self.file('meta.json.tmp'), self.file('meta.json'))
+        if os.path.exists(self.file(f'inps_{i - 1}.pt')):
+            os.remove(self.file(f'inps_{i - 1}.pt'))
+        self.done = i
+
+    def resume(self, layers, dev):
+        packed = {}
+        for i in range(self.done + 1):
+            state = torch.load(self.file(f'layer_{i}.pt'), map_location='cpu')
+            layers[i].load_state_dict(state['state_dict'])
+            packed.update(state['packed'] or {})
+        state = torch.load(self.file(f'inps_{self.done}.pt'), map_location='cpu')
+        attention_mask = state['attention_mask']
+        if attention_mask is not None:
+            attention_mask = attention_mask.to(dev)
+        return state['inps'], attention_mask, dict(state['extra'], packed=packed)
@@ -0,0 +1,107 @@
+import torch
+import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
+
+"""
+lm_head + loss computed a slice of tokens at a time, so the [tokens, vocab]
+fp32 logits are never materialized for a whole sequence. When gradients are
+needed each slice is checkpointed: its logits are recomputed in backward
+instead of being kept alive until then.
+
+The one copy for both trees: gptq_pb imports it as `lm_loss`, the
+top-level scripts as `gptq_pb.lm_loss`, so it imports nothing but torch.
+"""
+
+
+def _chunks(fn, *tensors, chunk=1024):
+    # sum of fn over aligned `chunk`-row slices of `tensors`
+    total = 0
+    grad = torch.is_grad_enabled() and any(t.requires_grad for t in tensors)
+    for st in range(0, tensors[0].shape[0], chunk):
+        args = [t[st : st + chunk] for t in tensors]
+        if grad:
+            total = total + checkpoint(fn, *args, use_reentrant=False)
+        else:
+            total = total + fn(*args)
+    return total
+
+
+def chunked_nll(lm_head, hidden, labels, chunk=1024, ignore_index=-100):
+    """
+    Summed cross-entropy of lm_head(hidden) [n, hidden] against labels [n].
+    Returns (nll, number of labels that are not `ignore_index`).
+    """
+
+    def nll(h, y):
+        return F.cross_entropy(
+            lm_head(h).float(), y, ignore_index=ignore_index, reduction="sum"
+        )
+
+    return _chunks(nll, hidden, labels, chunk=chunk), int((labels != ignore_index).sum())
+
+
+def causal_lm_nll(lm_head, hidden_states, input_ids, chunk=1024, ignore_index=-100):
+    """
+    Next-token loss of hidden_states [batch, seq, hidden] against input_ids
+    (or labels) [batch, seq], shifted by one like the HF causal LM loss.
+    Returns (summed nll, number of scored tokens).
+    """
+    hidden = hidden_states[:, :-1].reshape(-1, hidden_states.shape[-1])
+    labels = input_ids[:, 1:].reshape(-1).to(hidden.device)
+    return chunked_nll(lm_head, hidden, labels, chunk, ignore_index)
+
+
+def window_starts(n_tokens, seqlen, stride=None):
+    # first token of every seqlen-token perplexity window, one every `stride`
+    # tokens (default seqlen: disjoint windows)
+    return list(range(0, n_tokens - seqlen + 1, stride or seqlen))
+
+
+def window_nll(lm_head, hidden_states, tokens, starts, seqlen, stride=None, chunk=1024):
+    """
+    Summed next-token nll and number of scored tokens of a batch of
+    perplexity windows: hidden_states [b, seqlen, hidden] of the windows
+    tokens[st:st + seqlen] for st in `starts`. Every window but the one at
+    0 only scores its last `stride` tokens, which no earlier window saw.
+    """
+    stride = stride or seqlen
+    hidden, labels = [], []
+    for j, st in enumerate(starts):
+        # hidden state p - 1 predicts token p of the window
+        lo = 1 if st == 0 else max(1, seqlen - stride)
+        hidden.append(hidden_states[j, lo - 1:seqlen - 1])
+        labels.append(tokens[st + lo:st + seqlen])
+    labels = torch.cat(labels).to(hidden_states.device)
+    return chunked_nll(lm_head, torch.cat(hidden), labels, chunk)
+
+
+def chunked_kl(student_head, student_hidden, teacher_head, teacher_hidden, temperature=1.0, chunk=1024):
+    """
+    Summed KL(teacher || student) of the temperature-softened token
+    distributions, from hidden states [n, hidden] of both models (which may
+    live on different devices); the teacher logits are computed without
+    gradient, slice by slice.
+    """
+
+    def kl(s, t):
+        log_probs = F.log_softmax(student_head(s).float() / temperature, dim=-1)
+        with torch.no_grad():
+            target = F.softmax(teacher_head(t).float() / temperature, dim=-1)
+        return F.kl_div(log_probs, target.to(log_probs.device), reduction="sum")
+
+    return _chunks(kl, student_hidden, teacher_hidden, chunk=chunk)
+
+
+def chunked_topk_kl(student_head, student_hidden, teacher_values, teacher_indices, temperature=1.0, chunk=1024):
+    """
+    chunked_kl against cached teacher outputs: the teacher distribution is
+    the softmax of its top-k logits `teacher_values` [n, k], over the
+    vocabulary entries `teacher_indices` [n, k] only.
+    """
+
+    def kl(s, v, i):
+        log_probs = F.log_softmax(student_head(s).float() / temperature, dim=-1)
+        target = F.log_softmax(v.float() / temperature, dim=-1)
+        return (target.exp() * (target - log_probs.gather(-1, i.long()))).sum()
+
+    return _chunks(kl, student_hidden, teacher_values, teacher_indices, chunk=chunk)
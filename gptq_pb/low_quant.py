@@ -5,7 +5,7 @@ import math
 
 class LowQuantizer(nn.Module):
 
-    def __init__(self, weight, method="xnor",groupsize=-1):
+    def __init__(self, weight, method="xnor",groupsize=-1, calib="heuristic", calib_iters=4, calib_hessian=False):
         super().__init__()
         oc,ic=weight.shape
         if groupsize==-1:
@@ -19,6 +19,11 @@ class LowQuantizer(nn.Module):
         self.register_buffer('scale', torch.zeros(self.n_groups,oc,1))
         self.register_buffer('mean', torch.zeros(self.n_groups,oc,1))
         self.method=method
+        # xnor only: "heuristic" calibrates per group in `calibrate`, the
+        # others fit all groups at once in `calibrate_groups`
+        self.calib=calib
+        self.calib_iters=calib_iters
+        self.calib_hessian=calib_hessian
 
 
     def calibrate(self, w, mask=None, groupi=0):
@@ -30,7 +35,7 @@ class LowQuantizer(nn.Module):
             # non_zero_nums = (w != 0).float().sum(-1,keepdim=True)
             # scale = w.abs().sum(-1,keepdim=True)/(non_zero_nums+1e-5)
             scale=w.abs().mean(-1,keepdim=True)
-            # TODO: search mean and scale
+            # masked / searched fit: see calibrate_groups
         elif self.method=="sign":
             # w_relu=F.relu(w)
             # scale=w_relu.sum()/((w>0).float().sum()+1e-5)
@@ -68,6 +73,64 @@ class LowQuantizer(nn.Module):
         self.scale[groupi]=scale
         self.scale.to(w.device)
 
+    def calibrate_groups(self, W, mask, hdiag=None, groupi=None):
+        """
+        Fit the xnor mean and scale of every row and group at once, over the
+        binarized entries (mask True) only, minimizing the squared error, or
+        the diag(H)-weighted one when `hdiag` is given. Starts from the
+        masked mean and mean-abs deviation; "alternating" then takes
+        `calib_iters` closed-form steps of
+            m = E[w - s*b],  s = E[b*(w - m)],  b = sign(w - m)
+        which never increase the error. Rows/groups where the heuristic of
+        `calibrate` does better keep the heuristic parameters.
+        With `groupi`, W is the slice of that one group and only its
+        parameters are set.
+        Returns the total error of the fitted and of the heuristic parameters.
+        """
+        rows, cols = W.shape
+        groupsize = self.groupsize
+        n_groups = math.ceil(cols / groupsize)
+        pad = n_groups * groupsize - cols
+        w = F.pad(W.float(), (0, pad)).reshape(rows, n_groups, groupsize)
+        m = F.pad(mask.float(), (0, pad)).reshape(rows, n_groups, groupsize)
+        valid = F.pad(torch.ones(cols, device=W.device), (0, pad)).reshape(1, n_groups, groupsize)
+        c = m
+        if hdiag is not None:
+            c = m * F.pad(hdiag.float(), (0, pad)).reshape(1, n_groups, groupsize)
+        total = c.sum(-1, keepdim=True).clamp_min(1e-12)
+
+        def error(mean, scale):
+            q = (w - mean).sign() * scale + mean
+            return (c * (w - q) ** 2).sum(-1, keepdim=True)
+
+        # what `calibrate` computes: statistics of W*mask, zeros included
+        n = valid.sum(-1, keepdim=True)
+        mean_h = (w * m).sum(-1, keepdim=True) / n
+        scale_h = (valid * (w * m - mean_h).abs()).sum(-1, keepdim=True) / n
+
+        mean = (c * w).sum(-1, keepdim=True) / total
+        scale = (c * (w - mean).abs()).sum(-1, keepdim=True) / total
+        if self.calib == "alternating":
+            for _ in range(self.calib_iters):
+                b = (w - mean).sign()
+                mean = (c * (w - scale * b)).sum(-1, keepdim=True) / total
+                scale = ((c * b * (w - mean)).sum(-1, keepdim=True) / total).clamp_min(0)
+        elif self.calib != "masked":
+            raise NotImplementedError(f"calib {self.calib} not implemented")
+
+        err = error(mean, scale)
+        err_h = error(mean_h, scale_h)
+        better = err <= err_h
+        mean = torch.where(better, mean, mean_h).transpose(0, 1).contiguous()
+        scale = torch.where(better, scale, scale_h).transpose(0, 1).contiguous()
+        if groupi is None:
+            self.mean, self.scale = mean, scale
+        else:
+            self.mean = self.mean.to(W.device)
+            self.scale = self.scale.to(W.device)
+            self.mean[groupi], self.scale[groupi] = mean[0], scale[0]
+        return torch.minimum(err, err_h).sum().item(), err_h.sum().item()
+
     def quantize(self, w,groupi=0):
         if w.device!=self.scale.device:
             self.scale=self.scale.to(w.device)
@@ -94,3 +157,27 @@ class LowQuantizer(nn.Module):
         elif self.method=="prune":
             return torch.zeros_like(w)
         return w
+
+    def quantize_fn(self, groupi=0, dev=None):
+        """
+        Return `lambda w: self.quantize(w, groupi)` with the parameters of
+        group `groupi` bound up front, for the per-column solver loop.
+        """
+        if dev is not None and self.scale.device != dev:
+            self.scale = self.scale.to(dev)
+            self.mean = self.mean.to(dev)
+        scale = self.scale[groupi]
+        mean = self.mean[groupi]
+        if self.method=="xnor":
+            return lambda w: (w - mean).sign() * scale + mean
+        elif self.method=="sign":
+            return lambda w: (w > 0).float() * scale
+        elif self.method=="rtn":
+            return lambda w: (F.relu(w) / scale).round().clamp(0, 1) * scale
+        elif self.method in ['2bit','4bit']:
+            zero = self.zero[groupi].to(scale.device)
+            maxq = self.maxq
+            return lambda w: scale * (torch.clamp(torch.round(w / scale) + zero, 0, maxq) - zero)
+        elif self.method=="prune":
+            return torch.zeros_like
+        return lambda w: w
@@ -2,7 +2,7 @@ import torch
 import torch.nn as nn
 
 
-DEV = torch.device('cuda:0')
+DEV = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
 
 
 def find_layers(module, layers=[nn.Conv2d, nn.Linear], name=''):
@@ -14,3 +14,45 @@ def find_layers(module, layers=[nn.Conv2d, nn.Linear], name=''):
             child, layers=layers, name=name + '.' + name1 if name != '' else name1
         ))
     return res
+
+
+def sync(dev):
+    if torch.device(dev).type == 'cuda':
+        torch.cuda.synchronize(dev)
+
+
+def empty_cache(dev):
+    if torch.device(dev).type == 'cuda':
+        torch.cuda.empty_cache()
+
+
+def set_threads(threads):
+    # intra-op parallelism for the CPU path; 0 keeps the torch default
+    if threads > 0:
+        torch.set_num_threads(threads)
+    print(f'torch threads: {torch.get_num_threads()}')
+
+
+def free_memory(dev):
+    # bytes currently available for new allocations on `dev`
+    dev = torch.device(dev)
+    if dev.type == 'cuda':
+        return torch.cuda.mem_get_info(dev)[0]
+    import os
+    return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+
+
+def forward_layer(layer, inps, outs, nsamples, attention_mask, micro_batch=1, step=None):
+    """
+    outs[j] = layer(inps[j]) for every sample, forwarding `micro_batch`
+    samples at once. The attention mask captured for a single sample is
+    expanded over the batch; `step` is called after every forward.
+    """
+    for st in range(0, nsamples, micro_batch):
+        ed = min(st + micro_batch, nsamples)
+        mask = attention_mask
+        if mask is not None and mask.dim() == 4:
+            mask = mask[:1].expand(ed - st, -1, -1, -1)
+        outs[st:ed] = layer(inps[st:ed], attention_mask=mask)[0]
+        if step is not None:
+            step()
@@ -0,0 +1,231 @@
+import os
+import time
+
+import torch
+import torch.nn.functional as F
+
+
+PACKED_FILE = 'pbllm.pt'
+PACK_METHODS = ('xnor', 'sign')
+MAX_HIGH_BIT = 16
+
+
+def check_packable(method, high_bit):
+    # raise if pack_linear cannot encode weights of this configuration
+    if method not in PACK_METHODS:
+        raise NotImplementedError(f"packing of method {method} not implemented")
+    if not 1 <= high_bit <= MAX_HIGH_BIT:
+        raise NotImplementedError(f"packing of {high_bit}-bit salient weights not implemented")
+
+
+def quant_bits(high_quantizer):
+    # bit width of a HighQuantizer, from maxq = 2**bits - 1
+    return (int(high_quantizer.maxq) + 1).bit_length() - 1
+
+
+def zero_dtype(high_bit):
+    # smallest integer dtype holding high_bit-bit zero points
+    if high_bit <= 8:
+        return torch.uint8
+    if high_bit <= 15:
+        return torch.int16
+    return torch.int32
+
+
+def pack_bits(bits):
+    # bool [..., n] -> uint8 [..., ceil(n / 8)], little-endian within a byte
+    bits = bits.to(torch.uint8)
+    pad = (-bits.shape[-1]) % 8
+    if pad:
+        bits = F.pad(bits, (0, pad))
+    bits = bits.reshape(*bits.shape[:-1], -1, 8)
+    shifts = torch.arange(8, dtype=torch.uint8, device=bits.device)
+    return (bits << shifts).sum(-1, dtype=torch.uint8)
+
+
+def unpack_bits(packed, n):
+    shifts = torch.arange(8, dtype=torch.uint8, device=packed.device)
+    bits = (packed.unsqueeze(-1) >> shifts) & 1
+    return bits.reshape(*packed.shape[:-1], -1)[..., :n].bool()
+
+
+def pack_ints(values, bits):
+    # flat ints in [0, 2**bits) -> uint8 bitstream of `bits` bits per value,
+    # little-endian (for 1/2/4 bits: 8 // bits whole values per byte)
+    shifts = torch.arange(bits, device=values.device)
+    return pack_bits(((values.long().unsqueeze(-1) >> shifts) & 1).flatten())
+
+
+def unpack_ints(packed, bits, n):
+    shifts = torch.arange(bits, device=packed.device)
+    stream = unpack_bits(packed, n * bits).reshape(n, bits).long()
+    return (stream << shifts).sum(-1)
+
+
+def encode_mask(mask):
+    """
+    Salient-weight mask as whichever is smaller: a bitmap, or CSR-style
+    per-row column indices (int16 when the row fits).
+    """
+    rows, cols = mask.shape
+    counts = mask.sum(1)
+    nnz = int(counts.sum())
+    index_dtype = torch.int16 if cols <= 2 ** 15 else torch.int32
+    index_bytes = nnz * (2 if index_dtype == torch.int16 else 4) + 4 * (rows + 1)
+    if index_bytes < rows * ((cols + 7) // 8):
+        crow = torch.zeros(rows + 1, dtype=torch.int32, device=mask.device)
+        crow[1:] = torch.cumsum(counts, 0)
+        return {'format': 'csr', 'crow': crow, 'col': mask.nonzero()[:, 1].to(index_dtype)}
+    return {'format': 'bitmap', 'bits': pack_bits(mask)}
+
+
+def decode_mask(encoded, shape):
+    rows, cols = shape
+    if encoded['format'] == 'bitmap':
+        return unpack_bits(encoded['bits'], cols)
+    crow, col = encoded['crow'].long(), encoded['col'].long()
+    row = torch.repeat_interleave(torch.arange(rows, device=col.device), crow[1:] - crow[:-1])
+    mask = torch.zeros(shape, dtype=torch.bool, device=col.device)
+    mask[row, col] = True
+    return mask
+
+
+def salient_params(high_scale, high_zero, row, col, groupsize):
+    # high-bit scale and zero of the salient entries at (row, col): per row
+    # ([rows]) or, from a groupwise run, per group and row ([n_groups, rows])
+    if high_scale.dim() == 1:
+        return high_scale[row].float(), high_zero[row].float()
+    group = col // groupsize
+    return high_scale[group, row].float(), high_zero[group, row].float()
+
+
+def pack_linear(W, mask, low_quantizer, high_quantizer, high_groups=None, perm=None):
+    """
+    Pack a fake-quantized PB-LLM weight W [rows, cols] (fp32, as produced by
+    LowHighGPT.fasterquant). `mask` is True for binarized weights. Binarized
+    weights become sign bits (salient positions hold 0) with per-row,
+    per-group scale and mean; salient weights are stored as `high_bit`
+    integers with the per-row scale and zero of the high-bit quantizer, or
+    with the per-group ones in `high_groups` ({groupi: (fp16 scale, integer
+    zero, see zero_dtype)}) from a groupwise run, whose scales are all kept
+    in fp16.
+
+    With `perm` (act-order), W and mask are in the permuted column order the
+    sweep ran in and are packed as such, so groups stay contiguous; the
+    permutation is stored and applied to the input columns instead, see
+    PackedPBLinear.
+    """
+    high_bit = quant_bits(high_quantizer)
+    check_packable(low_quantizer.method, high_bit)
+    rows, cols = W.shape
+    salient = ~mask
+    scale = low_quantizer.scale[:, :, 0].to(W.device)
+    mean = low_quantizer.mean[:, :, 0].to(W.device)
+    group = torch.arange(cols, device=W.device) // low_quantizer.groupsize
+    if low_quantizer.method == 'xnor':
+        signs = W > mean.t()[:, group]
+    else:
+        signs = W > 0
+    if high_groups is None:
+        high_scale = high_quantizer.scale.reshape(-1).to(W.device).float()
+        high_zero = high_quantizer.zero.reshape(-1).to(W.device).float()
+        scale, mean = scale.float(), mean.float()
+    else:
+        high_scale = torch.stack([high_groups[g][0] for g in sorted(high_groups)]).to(W.device)
+        high_zero = torch.stack([high_groups[g][1] for g in sorted(high_groups)]).to(W.device)
+        scale, mean = scale.half(), mean.half()
+    row, col = salient.nonzero().unbind(1)
+    row_scale, row_zero = salient_params(high_scale, high_zero, row, col, low_quantizer.groupsize)
+    ints = torch.round(W[salient] / row_scale + row_zero)
+    return {
+        'shape': (rows, cols),
+        'method': low_quantizer.method,
+        'groupsize': low_quantizer.groupsize,
+        'signs': pack_bits(signs & mask).cpu(),
+        'low_scale': scale.cpu(),
+        'low_mean': mean.cpu(),
+        'salient': {k: v.cpu() if torch.is_tensor(v) else v for k, v in encode_mask(salient).items()},
+        'nnz': int(row.numel()),
+        'high_bit': high_bit,
+        'high_scale': high_scale.cpu(),
+        'high_zero': high_zero.cpu(),
+        'values': pack_ints(ints, high_bit).cpu(),
+        'perm': perm.cpu() if perm is not None else None,
+    }
+
+
+def unpack_linear(packed, dev='cpu'):
+    rows, cols = packed['shape']
+    group = torch.arange(cols, device=dev) // packed['groupsize']
+    scale = packed['low_scale'].to(dev).float().t()[:, group]
+    signs = unpack_bits(packed['signs'].to(dev), cols)
+    if packed['method'] == 'xnor':
+        W = torch.where(signs, scale, -scale) + packed['low_mean'].to(dev).float().t()[:, group]
+    else:
+        W = signs.float() * scale
+    salient = decode_mask({k: v.to(dev) if torch.is_tensor(v) else v
+                           for k, v in packed['salient'].items()}, (rows, cols))
+    row, col = salient.nonzero().unbind(1)
+    ints = unpack_ints(packed['values'].to(dev), packed['high_bit'], packed['nnz'])
+    high_scale, high_zero = salient_params(packed['high_scale'].to(dev), packed['high_zero'].to(dev),
+                                           row, col, packed['groupsize'])
+    W[salient] = high_scale * (ints - high_zero)
+    if packed.get('perm') is not None:
+        W = W[:, torch.argsort(packed['perm'].to(dev))]
+    return W
+
+
+def packed_bytes(obj):
+    if torch.is_tensor(obj):
+        return obj.numel() * obj.element_size()
+    if isinstance(obj, dict):
+        return sum(packed_bytes(v) for v in obj.values())
+    return 0
+
+
+def save_packed(model, packed, path):
+    """
+    Write `model` with the layers in `packed` ({module name: pack_linear(...)})
+    stored bit-packed; everything else is kept as fp16.
+    """
+    os.makedirs(path, exist_ok=True)
+    model.config.save_pretrained(path)
+    dense = {
+        k: v.half() if v.is_floating_point() else v
+        for k, v in model.state_dict().items()
+        if not (k.endswith('.weight') and k[:-len('.weight')] in packed)
+    }
+    torch.save({'dense': dense, 'packed': packed}, os.path.join(path, PACKED_FILE))
+    full = sum(v.numel() * 2 for v in model.state_dict().values() if v.is_floating_point())
+    print(f'saved packed model to {path}: {os.path.getsize(os.path.join(path, PACKED_FILE)) / 2**20:.1f} MB '
+          f'(packed layers {packed_bytes(packed) / 2**20:.1f} MB, fp16 model {full / 2**20:.1f} MB)')
+
+
+def load_packed(path, dtype=torch.float16, packed_linear=False):
+    """
+    Rebuild a model written by `save_packed`. Packed layers are unpacked into
+    dense `dtype` weights, or with `packed_linear` replaced by PackedPBLinear
+    modules that compute from the packed encoding.
+    """
+    def skip(*args, **kwargs):
+        pass
+    torch.nn.init.kaiming_uniform_ = skip
+    torch.nn.init.uniform_ = skip
+    torch.nn.init.normal_ = skip
+    from transformers import AutoConfig, AutoModelForCausalLM
+
+    tick = time.time()
+    config = AutoConfig.from_pretrained(path)
+    model = AutoModelForCausalLM.from_config(config, torch_dtype=dtype)
+    state = torch.load(os.path.join(path, PACKED_FILE), map_location='cpu')
+    model.load_state_dict(state['dense'], strict=False)
+    for name, packed in state['packed'].items():
+        module = model.get_submodule(name)
+        if packed_linear:
+            from packed_linear import PackedPBLinear
+            father, _, child = name.rpartition('.')
+            setattr(model.get_submodule(father), child, PackedPBLinear(packed, module.bias))
+        else:
+            module.weight.data = unpack_linear(packed).to(dtype)
+    print(f'loaded packed model from {path} in {time.time() - tick:.2f}s')
+    return model
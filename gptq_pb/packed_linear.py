@@ -0,0 +1,131 @@
+import torch
+import torch.nn as nn
+
+from pack import unpack_bits, decode_mask, unpack_ints, salient_params
+
+
+class PackedPBLinear(nn.Module):
+    """
+    Inference-only linear layer that computes directly from a `pack_linear`
+    encoding instead of a dense weight:
+
+        y = sum_g (x_g @ B_g^T) * scale_g + x_g.sum(-1) * mean_g + x @ S^T + bias
+
+    B is the +-1 sign matrix (0/1 for the `sign` binarizer), stored
+    bit-packed. With `cache_tiles` (the default) it is unpacked once, on the
+    first call, into int8 tiles of `tile` output rows (8 bits per entry
+    resident); otherwise every call unpacks it again tile by tile, keeping
+    the resident weight at 1 bit per entry. Each tile is widened to the
+    compute dtype (that of x on GPU, fp32 on CPU) only for its own GEMM.
+    S is a sparse CSR matrix with int32 indices and fp16 values, holding for
+    the salient weights only the high-bit value minus the binary value the
+    sign bits encode at that position.
+
+    The decoded tiles and the CSR tensor are caches, not state: moving the
+    layer (`.to`, `.cpu`, ...) drops them, and they are rebuilt on the next
+    call on the new device.
+
+    Act-order checkpoints keep the weight in the permuted column order, so
+    the only runtime cost of the permutation is one index_select of x per
+    call rather than a gather per group.
+    """
+
+    def __init__(self, packed, bias=None, tile=1024, cache_tiles=True):
+        super().__init__()
+        self.rows, self.columns = packed['shape']
+        self.method = packed['method']
+        self.groupsize = packed['groupsize']
+        self.tile = tile
+        self.cache_tiles = cache_tiles
+        self.tiles = None
+        self.sparse = None
+        self.register_buffer('signs', packed['signs'])
+        self.register_buffer('scale', packed['low_scale'].float())
+        self.register_buffer('mean', packed['low_mean'].float())
+
+        salient = decode_mask(packed['salient'], packed['shape'])
+        row, col = salient.nonzero().unbind(1)
+        ints = unpack_ints(packed['values'], packed['high_bit'], packed['nnz'])
+        high_scale, high_zero = salient_params(packed['high_scale'], packed['high_zero'],
+                                               row, col, self.groupsize)
+        values = high_scale * (ints - high_zero)
+        if self.method == 'xnor':
+            # sign bits are 0 at salient positions, i.e. -scale + mean
+            group = col // self.groupsize
+            values = values + self.scale[group, row] - self.mean[group, row]
+        self.register_buffer('crow', torch.cat([
+            torch.zeros(1, dtype=torch.long), torch.cumsum(torch.bincount(row, minlength=self.rows), 0)
+        ]).int())
+        self.register_buffer('col', col.int())
+        self.register_buffer('values', values.half())
+        if packed.get('perm') is not None:
+            self.register_buffer('perm', packed['perm'].long())
+        else:
+            self.perm = None
+        if bias is not None:
+            self.register_buffer('bias', bias.detach().float())
+        else:
+            self.bias = None
+
+    def binary(self, st, ed):
+        bits = unpack_bits(self.signs[st:ed], self.columns).to(torch.int8)
+        if self.method == 'xnor':
+            return bits * 2 - 1
+        return bits
+
+    def _apply(self, fn, *args, **kwargs):
+        # drop the decoded caches, so they do not stay behind on the old device
+        self.tiles = None
+        self.sparse = None
+        return super()._apply(fn, *args, **kwargs)
+
+    def tile_weights(self):
+        # int8 sign tiles, unpacked once
+        starts = range(0, self.rows, self.tile)
+        if not self.cache_tiles:
+            return (self.binary(st, min(st + self.tile, self.rows)) for st in starts)
+        if self.tiles is None:
+            self.tiles = [self.binary(st, min(st + self.tile, self.rows)) for st in starts]
+        return self.tiles
+
+    def sparse_weight(self, dtype):
+        # CSR over the int32/fp16 buffers; a copy of the values only for a
+        # compute dtype other than fp16
+        if self.sparse is None or self.sparse.dtype != dtype:
+            self.sparse = torch.sparse_csr_tensor(self.crow, self.col, self.values.to(dtype),
+                                                  (self.rows, self.columns))
+        return self.sparse
+
+    def resident_bytes(self):
+        # buffers plus whatever the caches hold beyond them
+        total = sum(b.numel() * b.element_size() for b in self.buffers())
+        if self.tiles is not None:
+            total += sum(B.numel() * B.element_size() for B in self.tiles)
+        if self.sparse is not None and self.sparse.values().data_ptr() != self.values.data_ptr():
+            total += self.sparse.values().numel() * self.sparse.values().element_size()
+        return total
+
+    @torch.no_grad()
+    def forward(self, x):
+        shape = x.shape
+        dtype = x.dtype if x.is_cuda else torch.float32
+        x2 = x.reshape(-1, self.columns).to(dtype)
+        if self.perm is not None:
+            x2 = x2.index_select(1, self.perm)
+        y = torch.zeros(x2.shape[0], self.rows, device=x.device, dtype=dtype)
+        for st, B in zip(range(0, self.rows, self.tile), self.tile_weights()):
+            ed = min(st + self.tile, self.rows)
+            B = B.to(dtype)
+            for groupi, cs in enumerate(range(0, self.columns, self.groupsize)):
+                ce = min(cs + self.groupsize, self.columns)
+                xg = x2[:, cs:ce]
+                y[:, st:ed] += xg.matmul(B[:, cs:ce].t()) * self.scale[groupi, st:ed]
+                if self.method == 'xnor':
+                    y[:, st:ed] += xg.sum(-1, keepdim=True) * self.mean[groupi, st:ed]
+        y += torch.sparse.mm(self.sparse_weight(dtype), x2.t()).t()
+        if self.bias is not None:
+            y += self.bias
+        return y.to(x.dtype).reshape(*shape[:-1], self.rows)
+
+    def extra_repr(self):
+        return f'{self.columns}, {self.rows}, method={self.method}, salient={self.values.numel()}'
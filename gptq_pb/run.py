@@ -3,12 +3,16 @@ import time
 import torch
 import torch.nn as nn
 
-from gptq import LowHighGPT
+from gptq import LowHighGPT, HessianRegistry
 from high_quant import HighQuantizer
 from low_quant import LowQuantizer
-from modelutils import find_layers
+from modelutils import find_layers, empty_cache, set_threads, forward_layer
+from scheduler import fasterquant_parallel
+from journal import QuantJournal
+from activations import ActivationStore, offload_path
+from pack import save_packed, load_packed, check_packable
 
-def get_model(model):
+def get_model(model, dtype='auto'):
     import torch
     def skip(*args, **kwargs):
         pass
@@ -17,21 +21,16 @@ def get_model(model):
     torch.nn.init.normal_ = skip
     if 'opt' in model:
         from transformers import OPTForCausalLM
-        model = OPTForCausalLM.from_pretrained(model, torch_dtype='auto')
+        model = OPTForCausalLM.from_pretrained(model, torch_dtype=dtype)
         model.seqlen = model.config.max_position_embeddings
     elif 'huggyllama' in model:
         from transformers import LlamaForCausalLM
-        model = LlamaForCausalLM.from_pretrained(model, torch_dtype='auto')
+        model = LlamaForCausalLM.from_pretrained(model, torch_dtype=dtype)
         model.seqlen = 2048
     return model
 
 @torch.no_grad()
-def quant_sequential(model, dataloader, dev):
-    print('Starting ...')
-
-    use_cache = model.config.use_cache
-    model.config.use_cache = False
-
+def capture_inputs(model, dataloader, dev):
     if 'opt' in args.model:
         layers = model.model.decoder.layers
         model.model.decoder.embed_tokens = model.model.decoder.embed_tokens.to(dev) 
@@ -47,8 +46,9 @@ def quant_sequential(model, dataloader, dev):
     layers[0] = layers[0].to(dev)
 
     dtype = next(iter(model.parameters())).dtype
-    inps = torch.zeros(
-        (args.nsamples, model.seqlen, model.config.hidden_size), dtype=dtype, device=dev
+    inps = ActivationStore(
+        (args.nsamples, model.seqlen, model.config.hidden_size), dtype, dev,
+        offload_path(args.offload_dir, 'inps.bin')
     )
     cache = {'i': 0, 'attention_mask': None}
 
@@ -80,15 +80,41 @@ def quant_sequential(model, dataloader, dev):
     elif 'huggyllama' in args.model:
         model.model.embed_tokens = model.model.embed_tokens.cpu()
         model.model.norm = model.model.norm.cpu()
-    torch.cuda.empty_cache()
+    empty_cache(dev)
+    return inps, cache['attention_mask']
+
+@torch.no_grad()
+def quant_sequential(model, dataloader, dev, journal=None):
+    print('Starting ...')
+
+    use_cache = model.config.use_cache
+    model.config.use_cache = False
+
+    if 'opt' in args.model:
+        layers = model.model.decoder.layers
+        prefix = 'model.decoder.layers'
+    elif 'huggyllama' in args.model:
+        layers = model.model.layers
+        prefix = 'model.layers'
 
-    outs = torch.zeros_like(inps)
-    attention_mask = cache['attention_mask']
+    if journal is not None and journal.done >= 0:
+        start = journal.done + 1
+        saved, attention_mask, extra = journal.resume(layers, dev)
+        inps = ActivationStore(saved.shape, saved.dtype, dev, offload_path(args.offload_dir, 'inps.bin'))
+        inps[:] = saved
+        del saved
+        plt_x, plt_error, packed = extra['plt_x'], extra['plt_error'], extra['packed']
+        print(f'Resuming from layer {start}.')
+    else:
+        start = 0
+        inps, attention_mask = capture_inputs(model, dataloader, dev)
+        plt_x=[]
+        plt_error=[]
+        packed={}
+    outs = inps.like(offload_path(args.offload_dir, 'outs.bin'))
 
     print('Ready.')
-    plt_x=[]
-    plt_error=[]
-    for i in range(len(layers)):
+    for i in range(start, len(layers)):
         layer = layers[i].to(dev)
 
         subset = find_layers(layer)
@@ -97,42 +123,68 @@ def quant_sequential(model, dataloader, dev):
         for name in subset:
             if (not (args.minlayer <= i < args.maxlayer and args.quant_only in name)) == (not args.invert):
               continue
-            low_quantizer=LowQuantizer(subset[name].weight,method=args.low_quant_method, groupsize=args.groupsize)
-            high_quantizer=HighQuantizer(args.high_bit,True,False,False,)
-            gpts[name] = LowHighGPT(subset[name],low_quantizer,high_quantizer, salient_metric=args.salient_metric,disable_gptq=args.disable_gptq)
+            low_quantizer=LowQuantizer(subset[name].weight,method=args.low_quant_method, groupsize=args.groupsize,
+                                       calib=args.low_calib, calib_iters=args.low_calib_iters, calib_hessian=args.low_calib_hessian)
+            high_quantizer=HighQuantizer(args.high_bit,True,False,args.high_mse,mse_refine=args.mse_refine)
+            gpts[name] = LowHighGPT(subset[name],low_quantizer,high_quantizer, salient_metric=args.salient_metric,disable_gptq=args.disable_gptq,token_budget=args.hessian_tokens)
 
+        registry = HessianRegistry() if args.share_hessian else None
         def add_batch(name):
             def tmp(_, inp, out):
-                gpts[name].add_batch(inp[0].data, out.data)
+                if registry is not None:
+                    registry.add_batch(name, gpts[name], inp[0], out)
+                else:
+                    gpts[name].add_batch(inp[0].data, out.data)
             return tmp
         handles = []
         for name in gpts:
             handles.append(subset[name].register_forward_hook(add_batch(name)))
-        for j in range(args.nsamples):
-            outs[j] = layer(inps[j].unsqueeze(0), attention_mask=attention_mask)[0]
+        forward_layer(layer, inps, outs, args.nsamples, attention_mask, args.micro_batch,
+                      step=registry.step if registry is not None else None)
         for h in handles:
             h.remove()
+        if registry is not None:
+            registry.report()
 
+        packed_block = {}
+        if args.workers > 1:
+            infos=fasterquant_parallel(
+                gpts, args.workers, dev, low_frac=args.low_frac, percdamp=args.percdamp,
+                blocksize=args.blocksize, solver=args.solver, compare_solver=args.compare_solver,
+                pack=args.save_packed, salient_sample=args.salient_sample,
+                groupwise=args.groupwise, act_order=args.act_order,
+            )
         for name in gpts:
             print(i, name)
-            print('Quantizing ...')
-            info=gpts[name].fasterquant(
-                args.low_frac, percdamp=args.percdamp, blocksize=args.blocksize
-            )
+            if args.workers > 1:
+                info=infos[name]
+            else:
+                print('Quantizing ...')
+                info=gpts[name].fasterquant(
+                    args.low_frac, percdamp=args.percdamp, blocksize=args.blocksize,
+                    solver=args.solver, compare_solver=args.compare_solver,
+                    pack=args.save_packed, salient_sample=args.salient_sample,
+                    groupwise=args.groupwise, act_order=args.act_order,
+                )
+            if args.save_packed:
+                packed_block[f"{prefix}.{i}.{name}"] = gpts[name].packed
             gpts[name].free()
             plt_x.append(f"{i}_{name}")
             plt_error.append(info["error"])
 
 
-        for j in range(args.nsamples):
-            outs[j] = layer(inps[j].unsqueeze(0), attention_mask=attention_mask)[0]
+        forward_layer(layer, inps, outs, args.nsamples, attention_mask, args.micro_batch)
 
         layers[i] = layer.cpu()
         del layer
         del gpts
-        torch.cuda.empty_cache()
+        empty_cache(dev)
 
         inps, outs = outs, inps
+        packed.update(packed_block)
+        if journal is not None:
+            journal.commit(i, layers[i], inps, attention_mask,
+                           {'plt_x': plt_x, 'plt_error': plt_error}, packed_block)
     if args.plot:
         title=f"{args.model}_{args.dataset}_{args.low_quant_method}_{args.low_frac}_{args.high_bit}"
         torch.save([plt_x,plt_error],"../output/"+title.replace("/","_")+'.pkl')
@@ -142,7 +194,10 @@ def quant_sequential(model, dataloader, dev):
         plt.title(title)
         plt.savefig("../output/"+title.replace("/","_")+'.jpg')
 
+    inps.close()
+    outs.close()
     model.config.use_cache = use_cache
+    return packed
 
 
 
@@ -193,9 +248,41 @@ if __name__ == '__main__':
         help='Groupsize for GPTQ quantizing'
     )
     parser.add_argument("--salient_metric", type=str, default="magnitude", choices=["magnitude","hessian"])
+    parser.add_argument(
+        '--groupwise', action='store_true',
+        help='Recalibrate the high-bit and binary quantizers at every --groupsize boundary during the GPTQ sweep, on the already updated weights; any groupsize is allowed.'
+    )
+    parser.add_argument(
+        '--act_order', action='store_true',
+        help='Quantize the columns in order of decreasing Hessian diagonal; packed checkpoints store the permutation.'
+    )
+    parser.add_argument(
+        '--salient_sample', type=int, default=0,
+        help='Estimate each group\'s salient threshold from this many sampled weights instead of exact selection; 0 is exact.'
+    )
     parser.add_argument(
         '--high_bit', type=int, default=8,
     )
+    parser.add_argument(
+        '--high_mse', action='store_true',
+        help='Search the clipping range of the high-bit quantizer for minimal error.'
+    )
+    parser.add_argument(
+        '--mse_refine', type=int, default=0,
+        help='With --high_mse: coarse search with this stride, then refine around the best step; 0 searches every step.'
+    )
+    parser.add_argument(
+        '--low_calib', type=str, default='heuristic', choices=['heuristic', 'masked', 'alternating'],
+        help='How to fit the xnor mean/scale: the original per-group statistics, exact statistics over the binarized weights only, or those refined by alternating closed-form steps.'
+    )
+    parser.add_argument(
+        '--low_calib_iters', type=int, default=4,
+        help='Number of alternating steps for --low_calib alternating.'
+    )
+    parser.add_argument(
+        '--low_calib_hessian', action='store_true',
+        help='Weight the xnor fit by the Hessian diagonal of each input column.'
+    )
     parser.add_argument(
         '--minlayer', type=int, default=-1,
         help='Quant all layers with id >= this.'
@@ -215,30 +302,100 @@ if __name__ == '__main__':
     parser.add_argument(
        '--save', action='store_true',
     )
+    parser.add_argument(
+       '--save_packed', action='store_true',
+       help='Also save a bit-packed PB-LLM checkpoint (binary signs, salient mask and high-bit values); --load_quantized prefers it.'
+    )
+    parser.add_argument(
+       '--packed_linear', action='store_true',
+       help='With --load_quantized, run packed layers through PackedPBLinear instead of unpacking them to dense weights.'
+    )
     parser.add_argument(
        '--disable_gptq', action="store_true",
     )
+    parser.add_argument(
+       '--solver', type=str, default="column", choices=["column", "lazy"],
+       help='GPTQ sweep: `column` is the reference per-column loop, `lazy` binds quantizer parameters per block and fuses the updates.'
+    )
+    parser.add_argument(
+       '--compare_solver', action="store_true",
+       help='Also run the `column` solver on each layer and report max weight difference and speedup.'
+    )
+    parser.add_argument(
+       '--hessian_tokens', type=int, default=0,
+       help='Buffer this many calibration tokens per layer before updating the Hessian (upper-triangle rank-k update, normalized once); 0 updates on every batch.'
+    )
+    parser.add_argument(
+       '--share_hessian', action='store_true',
+       help='Accumulate and factorize one Hessian per distinct sublayer input (e.g. q/k/v_proj) instead of one per sublayer.'
+    )
+    parser.add_argument(
+       '--workers', type=int, default=1,
+       help='Quantize the sublayers of a block concurrently on this many threads (capped by free memory).'
+    )
+    parser.add_argument(
+       '--journal', type=str, default='',
+       help='Directory to journal finished blocks and their output activations to; a restarted run resumes after the last journaled block.'
+    )
+    parser.add_argument(
+       '--offload_dir', type=str, default='',
+       help='Keep the propagated activations in memory-mapped files in this directory instead of on the device.'
+    )
+    parser.add_argument(
+       '--micro_batch', type=int, default=1,
+       help='Number of samples (evaluation windows) per layer forward in the calibration and evaluation loops.'
+    )
+    parser.add_argument(
+       '--eval_stride', type=int, default=0,
+       help='Start a perplexity window every this many tokens, scoring only the tokens new to it; 0 uses disjoint seqlen windows.'
+    )
+    parser.add_argument(
+       '--device', type=str, default="cuda:0",
+       help='Device to quantize and evaluate on, e.g. `cuda:0` or `cpu`.'
+    )
+    parser.add_argument(
+       '--threads', type=int, default=0,
+       help='Intra-op threads for torch (CPU path); 0 keeps the torch default.'
+    )
     parser.add_argument(
        '--log_wandb', action='store_true',
        help='Whether to log to wandb.'
     )
 
     args = parser.parse_args()
+    if args.save_packed:
+        # fail before calibrating rather than after the first block
+        check_packable(args.low_quant_method, args.high_bit)
 
-    device="cuda:0"
+    device=args.device
+    set_threads(args.threads)
+    # fp16 matmuls are slow or unsupported on CPU, quantize in fp32 there
+    dtype='auto' if torch.device(device).type=='cuda' else torch.float32
     save_title=f"{args.model}_{args.dataset}_{args.low_quant_method}_{args.low_frac}_{args.high_bit}_{args.groupsize}_{args.salient_metric}"
     save_file="../output/"+save_title.replace("/","_")+".pt"
-    if args.load_quantized:
-        model = get_model(save_file)
+    packed_file="../output/"+save_title.replace("/","_")+"_pbllm"
+    if args.load_quantized and os.path.exists(packed_file):
+        model = load_packed(packed_file, torch.float16 if dtype=='auto' else dtype, args.packed_linear)
+        model.seqlen = model.config.max_position_embeddings if 'opt' in args.model else 2048
+        model.eval()
+    elif args.load_quantized:
+        model = get_model(save_file, dtype)
         model.eval()
     elif args.low_frac:
-        model = get_model(args.model)
+        model = get_model(args.model, dtype)
         model.eval()
         tick = time.time()
         dataloader, testloader = get_loaders(
             args.dataset, nsamples=args.nsamples, seed=args.seed, model=args.model, seqlen=model.seqlen
         )
-        quant_sequential(model, dataloader, device)
+        journal = None
+        if args.journal:
+            # every argument that can change the quantized weights
+            runtime = {'plot', 'load_quantized', 'save', 'packed_linear', 'compare_solver', 'workers',
+                       'journal', 'offload_dir', 'micro_batch', 'eval_stride', 'threads', 'log_wandb'}
+            key = {k: v for k, v in sorted(vars(args).items()) if k not in runtime}
+            journal = QuantJournal(args.journal, key)
+        packed = quant_sequential(model, dataloader, device, journal)
         for n, p in model.named_parameters():
             print(n, torch.mean((p == 0).float()))
             if 'fc2' in n:
@@ -255,13 +412,17 @@ if __name__ == '__main__':
         print(dataset)
         if 'opt' in args.model:
             from eval_ppl_utils import opt_eval
-            opt_eval(model, testloader, device, dataset, args.log_wandb)
+            opt_eval(model, testloader, device, dataset, args.log_wandb, offload_dir=args.offload_dir, micro_batch=args.micro_batch,
+                     stride=args.eval_stride or None)
         elif 'huggyllama' in args.model:
             from eval_ppl_utils import llama_eval
-            llama_eval(model, testloader, device, dataset, args.log_wandb)
+            llama_eval(model, testloader, device, dataset, args.log_wandb, offload_dir=args.offload_dir, micro_batch=args.micro_batch,
+                     stride=args.eval_stride or None)
 
     if args.save:
         save_path=os.path.dirname(save_file)
         if not os.path.exists(save_path):
             os.makedirs(save_path)
         model.save_pretrained(save_file)
+    if args.save_packed and args.low_frac and not args.load_quantized:
+        save_packed(model, packed, packed_file)
@@ -10,6 +10,10 @@ CUDA_VISIBLE_DEVICES=0 python run.py huggyllama/llama-7b c4 xnor --low_frac 0.95
 # CUDA_VISIBLE_DEVICES=2 python run.py huggyllama/llama-7b c4 prune --low_frac 0.001 --high_bit 4
 
 
+# CPU-only: opt-125m end to end (quantization + ppl eval), pin --threads to the physical cores
+# python run.py facebook/opt-125m c4 xnor --low_frac 0.9 --high_bit 8 --device cpu --threads 32 --solver lazy
+
+
 # experiments on opt-1.3b
 # CUDA_VISIBLE_DEVICES=0 python run.py facebook/opt-1.3b c4 xnor --low_frac 0.5 --high_bit 8
 # CUDA_VISIBLE_DEVICES=1 python run.py facebook/opt-1.3b c4 xnor --low_frac 0.8 --high_bit 8
@@ -39,4 +43,8 @@ CUDA_VISIBLE_DEVICES=0 python run.py huggyllama/llama-7b c4 xnor --low_frac 0.95
 # CUDA_VISIBLE_DEVICES=0 python run.py facebook/opt-1.3b c4 xnor --low_frac 0.5 --high_bit 8 --disable_gptq  --salient_metric hessian
 # CUDA_VISIBLE_DEVICES=1 python run.py facebook/opt-1.3b c4 xnor --low_frac 0.8 --high_bit 8 --disable_gptq --salient_metric hessian
 # CUDA_VISIBLE_DEVICES=2 python run.py facebook/opt-1.3b c4 xnor --low_frac 0.9 --high_bit 8 --disable_gptq --salient_metric hessian
-# CUDA_VISIBLE_DEVICES=3 python run.py facebook/opt-1.3b c4 xnor --low_frac 0.95 --high_bit 8 --disable_gptq --salient_metric hessian
\ No newline at end of file
+# CUDA_VISIBLE_DEVICES=3 python run.py facebook/opt-1.3b c4 xnor --low_frac 0.95 --high_bit 8 --disable_gptq --salient_metric hessian
+# packed checkpoint + inference kernel
+# python run.py facebook/opt-125m c4 xnor --low_frac 0.9 --high_bit 8 --device cpu --save_packed
+# python run.py facebook/opt-125m c4 xnor --low_frac 0.9 --high_bit 8 --device cpu --load_quantized --packed_linear
+# python bench_packed.py --rows 4096 --columns 4096 --low_frac 0.9 --tokens 1 16 128
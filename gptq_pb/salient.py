@@ -0,0 +1,49 @@
+import torch
+
+
+def group_thresholds(saliency, groupsize, low_frac, sample=0):
+    """
+    Per-group binarization threshold of `saliency` [rows, cols]: the
+    int(n * low_frac)-th smallest (0-based) of the n = rows * groupsize
+    entries of each group of `groupsize` columns, i.e. what
+    `torch.sort(s.flatten())[0][int(n * low_frac)]` returns, found by
+    selection for all full groups in one batched kthvalue. With `sample` > 0
+    the quantile is estimated from that many uniformly drawn entries per
+    group instead. Returns a [n_groups] tensor.
+    """
+    rows, cols = saliency.shape
+    n_full = cols // groupsize
+    parts = []
+    if n_full:
+        parts.append(saliency[:, :n_full * groupsize].reshape(rows, n_full, groupsize)
+                     .transpose(0, 1).reshape(n_full, -1))
+    if cols % groupsize:
+        parts.append(saliency[:, n_full * groupsize:].reshape(1, -1))
+    thresh = []
+    for s in parts:
+        if sample and sample < s.shape[1]:
+            # fixed seed: the same layer gets the same mask on every run
+            gen = torch.Generator(device=s.device).manual_seed(0)
+            idx = torch.randint(s.shape[1], (s.shape[0], sample), device=s.device, generator=gen)
+            s = s.gather(1, idx)
+        k = min(int(s.shape[1] * low_frac) + 1, s.shape[1])
+        thresh.append(s.kthvalue(k, dim=1)[0])
+    return torch.cat(thresh)
+
+
+def salient_mask(W, groupsize, low_frac, metric="magnitude", Hinv=None, sample=0):
+    """
+    Binarization mask of W [rows, cols] (True = binarized, False = salient),
+    keeping roughly a 1 - low_frac fraction of every group at high bit.
+    `metric` is "magnitude" (|w|) or "hessian" (w^2 / [H^-1]_jj^2, with the
+    diagonal taken from the upper Cholesky factor `Hinv`).
+    """
+    if metric == "magnitude":
+        saliency = W.abs()
+    elif metric == "hessian":
+        saliency = W ** 2 / torch.diag(Hinv).reshape((1, -1)) ** 2
+    else:
+        raise NotImplementedError(f"salient metric {metric} not implemented")
+    thresh = group_thresholds(saliency, groupsize, low_frac, sample)
+    group = torch.arange(W.shape[1], device=W.device) // groupsize
+    return saliency <= thresh[group].reshape(1, -1)
@@ -0,0 +1,44 @@
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from modelutils import free_memory
+
+
+def _fasterquant_free(gpt, kwargs):
+    # drop the Hessian (and its factor, once no sharer holds it) as soon as
+    # this sublayer is done instead of at the end of the block
+    info = gpt.fasterquant(**kwargs)
+    gpt.free()
+    return info
+
+
+def fasterquant_parallel(gpts, workers, dev, mem_frac=.8, **kwargs):
+    """
+    Run `fasterquant(**kwargs)` for every LowHighGPT in `gpts` on a thread
+    pool. Their Hessians are complete at this point, so the sublayers are
+    independent; torch releases the GIL inside its kernels, so the threads
+    overlap on many-core hosts. A job is only started while the estimated
+    peak memory of the running jobs fits into `mem_frac` of the free memory
+    on `dev`; one job always runs even if it alone exceeds the budget.
+    Returns {name: info} in the order of `gpts`.
+    """
+    budget = mem_frac * free_memory(dev)
+    tick = time.time()
+    infos = {}
+    running = {}
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for name in gpts:
+            cost = gpts[name].quant_memory(kwargs.get('blocksize', 128))
+            while running and (len(running) >= workers or
+                               sum(running.values()) + cost > budget):
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    del running[future]
+            print('Quantizing', name, '...')
+            future = pool.submit(_fasterquant_free, gpts[name], kwargs)
+            running[future] = cost
+            infos[name] = future
+    infos = {name: future.result() for name, future in infos.items()}
+    print('block time %.2f' % (time.time() - tick))
+    return infos
+
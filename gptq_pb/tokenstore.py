@@ -0,0 +1,73 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+import torch
+
+
+class TokenStore:
+    """
+    A tokenized corpus as one flat token array in a memory-mapped file
+    (uint16 when the vocabulary fits, uint32 otherwise) plus an int64 index
+    of document start offsets. Built once per (tokenizer, dataset); opening
+    it again maps the files, and documents are read as zero-copy views.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        self.offsets = np.load(os.path.join(path, 'offsets.npy'))
+        self.tokens = np.memmap(os.path.join(path, 'tokens.bin'), dtype=meta['dtype'], mode='r',
+                                shape=(int(self.offsets[-1]),))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def doc_len(self, i):
+        return int(self.offsets[i + 1] - self.offsets[i])
+
+    def doc(self, i):
+        return self.tokens[self.offsets[i]:self.offsets[i + 1]]
+
+    def window(self, i, st, ed):
+        # tokens st:ed of document i as the [1, ed - st] int64 model input
+        return torch.from_numpy(self.doc(i)[st:ed].astype(np.int64)).unsqueeze(0)
+
+    @staticmethod
+    def build(path, docs, tokenizer, batch=1000):
+        dtype = np.uint16 if len(tokenizer) <= 2 ** 16 else np.uint32
+        os.makedirs(path, exist_ok=True)
+        offsets = [0]
+        with open(os.path.join(path, 'tokens.bin'), 'wb') as f:
+            for st in range(0, len(docs), batch):
+                for ids in tokenizer(docs[st:st + batch])['input_ids']:
+                    f.write(np.asarray(ids, dtype=dtype).tobytes())
+                    offsets.append(offsets[-1] + len(ids))
+        np.save(os.path.join(path, 'offsets.npy'), np.asarray(offsets, dtype=np.int64))
+        # written last: a store without meta.json is incomplete and rebuilt
+        with open(os.path.join(path, 'meta.json'), 'w') as f:
+            json.dump({'dtype': np.dtype(dtype).name, 'docs': len(offsets) - 1,
+                       'tokens': offsets[-1], 'tokenizer': tokenizer.name_or_path}, f)
+
+
+def tokenizer_hash(tokenizer):
+    # identifies the token ids a tokenizer produces, not where it was loaded
+    # from; also keys the top-level datautils caches
+    h = hashlib.sha1(type(tokenizer).__name__.encode())
+    h.update(json.dumps(sorted(tokenizer.get_vocab().items(), key=lambda kv: kv[1])).encode())
+    h.update(json.dumps(tokenizer.special_tokens_map, sort_keys=True, default=str).encode())
+    h.update(str(tokenizer('a')['input_ids']).encode())
+    return h.hexdigest()[:16]
+
+
+def token_store(tokenizer, name, docs, root='cache/tokens'):
+    """
+    Open the TokenStore `name` for `tokenizer`, building it from `docs()`
+    (a callable returning the list of documents, only called on a miss).
+    """
+    path = os.path.join(root, f'{name}_{tokenizer_hash(tokenizer)}')
+    if not os.path.exists(os.path.join(path, 'meta.json')):
+        TokenStore.build(path, docs(), tokenizer)
+    return TokenStore(path)
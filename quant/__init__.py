@@ -3,3 +3,5 @@ from .outlier_quantizer import *
 from .outlier_column import *
 from .outlier_window_fix import *
 from .outlier_unstruct import *
+from .sparse_outliers import *
+from .outlier_calibration import *
@@ -0,0 +1,109 @@
+import time
+from collections import defaultdict
+
+import torch
+
+from .quantile import kth_smallest
+from .outlier_quantizer import BinaryXnorExceptOutliersLinear, outlier_bounds
+from .outlier_column import OutliersQLinearColumn
+from .outlier_window_fix import OutliersQLinearWindowFix
+from .outlier_unstruct import OutliersQLinearUnstruct
+
+
+def _stack(tensors, device):
+    return torch.stack([t.to(device).reshape(-1) for t in tensors])
+
+
+def _calibrate_unstruct(layers, device, sample):
+    sensitivity = _stack([m.outlier_sensitivity() for m in layers], device)
+    thresh = kth_smallest(
+        sensitivity, sensitivity.shape[1] - layers[0].n_outliers, sample
+    )
+    masks = sensitivity >= thresh.view(-1, 1)
+    for m, mask in zip(layers, masks):
+        m.set_outlier_mask(mask.view(m.dense_quantizer.weight.shape))
+
+
+def _calibrate_xnor(layers, device, sample):
+    w = _stack([m.weight for m in layers], device)
+    lower_threshold, upper_threshold = outlier_bounds(w)
+    masks = (w < lower_threshold) | (w > upper_threshold)
+    for m, mask in zip(layers, masks):
+        m.set_outlier_mask(mask.view(m.weight.shape))
+
+
+def _calibrate_column(layers, device, sample):
+    index = torch.argsort(_stack([m.outlier_sensitivity() for m in layers], device))
+    for m, idx in zip(layers, index):
+        m.set_outlier_columns(idx)
+
+
+def _calibrate_window(layers, device, sample):
+    # already one vectorized argmax per layer
+    for m in layers:
+        m.outlier_calibration()
+
+
+def _group_key(m):
+    # (calibration, stacking key) of a layer still to be calibrated from its
+    # weight, or None
+    if isinstance(m, OutliersQLinearUnstruct):
+        if not m.outlier_calibrated and m.outlier_metric == "L1":
+            return _calibrate_unstruct, (m.dense_quantizer.weight.shape, m.n_outliers)
+    elif isinstance(m, BinaryXnorExceptOutliersLinear):
+        if m.outlier_crow is None:
+            return _calibrate_xnor, (m.weight.shape,)
+    elif isinstance(m, OutliersQLinearColumn):
+        # a nonzero index is a loaded calibration, kept by outlier_calibration
+        calibrated = m.outlier_calibrated or not (m.outlier_columns_index == 0).all()
+        if not calibrated and m.outlier_metric == "L1":
+            return _calibrate_column, (m.dense_quantizer.weight.shape, m.n_outlier_columns)
+    elif isinstance(m, OutliersQLinearWindowFix):
+        if not m.outlier_calibrated:
+            return _calibrate_window, (m.dense_quantizer.weight.shape,)
+    return None
+
+
+@torch.no_grad()
+def calibrate_outliers(model, device=None, sample=0, batch_numel=2**27):
+    """
+    Compute the outlier masks of all outlier layers of `model` up front,
+    instead of lazily in each layer's first forward. Layers of the same kind
+    and shape are stacked, up to `batch_numel` weights at a time, and share
+    one batched kthvalue / argsort on `device` (default: the layer's own
+    device). With `sample` > 0 the unstructured thresholds are estimated from
+    that many sampled entries per layer. Layers whose metric needs
+    activations still calibrate on their first forward.
+    """
+    tick = time.time()
+    groups = defaultdict(list)
+    lazy = 0
+    for m in model.modules():
+        key = _group_key(m)
+        if key is not None:
+            groups[key].append(m)
+        elif (
+            isinstance(m, (OutliersQLinearUnstruct, OutliersQLinearColumn))
+            and not m.outlier_calibrated
+        ):
+            lazy += 1
+
+    n_layers = 0
+    for (calibrate, key), layers in groups.items():
+        group_tick = time.time()
+        numel = key[0].numel()
+        per_batch = max(1, batch_numel // numel)
+        for st in range(0, len(layers), per_batch):
+            batch = layers[st : st + per_batch]
+            dev = torch.device(device or next(batch[0].parameters()).device)
+            calibrate(batch, dev, sample)
+        if dev.type == "cuda":
+            torch.cuda.synchronize(dev)
+        n_layers += len(layers)
+        print(
+            f"{calibrate.__name__[len('_calibrate_'):]}: {len(layers)} layers of shape {tuple(key[0])} calibrated in {time.time() - group_tick:.2f}s"
+        )
+    print(
+        f"outlier calibration of {n_layers} layers took {time.time() - tick:.2f}s, {lazy} left to calibrate on first forward"
+    )
+    return model
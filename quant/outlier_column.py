@@ -54,22 +54,29 @@ class OutliersQLinearColumn(nn.Module, BinaryInterface):
                 print(
                     f"calibrating outlier columns, outlier_fraction={self.outlier_fraction}, metric={self.outlier_metric}"
                 )
-                w = self.dense_quantizer.weight
-                if self.outlier_metric == "L1":
-                    sensitivity = torch.norm(w, p=1, dim=0).float()
-                elif self.outlier_metric == "act_L1":
-                    sensitivity = torch.norm(x, p=1, dim=0).float()
-                else:
-                    raise NotImplementedError
-                index = torch.argsort(sensitivity)
-                outlier_index_low = index[: self.n_outlier_columns // 2]
-                outlier_index_high = index[-self.n_outlier_columns // 2 :]
-                self.outlier_columns_index = torch.cat(
-                    [outlier_index_low, outlier_index_high]
-                )
-                # self.outlier_weight.data = w[:, self.outlier_columns_index]
+                self.set_outlier_columns(torch.argsort(self.outlier_sensitivity(x)))
             self.outlier_calibrated = True
 
+    def outlier_sensitivity(self, x=None):
+        w = self.dense_quantizer.weight
+        if self.outlier_metric == "L1":
+            sensitivity = torch.norm(w, p=1, dim=0).float()
+        elif self.outlier_metric == "act_L1":
+            sensitivity = torch.norm(x, p=1, dim=0).float()
+        else:
+            raise NotImplementedError
+        return sensitivity
+
+    def set_outlier_columns(self, index):
+        # index: the columns sorted by sensitivity
+        outlier_index_low = index[: self.n_outlier_columns // 2]
+        outlier_index_high = index[-self.n_outlier_columns // 2 :]
+        self.outlier_columns_index = torch.cat(
+            [outlier_index_low, outlier_index_high]
+        ).to(self.outlier_columns_index.device)
+        # self.outlier_weight.data = w[:, self.outlier_columns_index]
+        self.outlier_calibrated = True
+
     def binarize_except_outliers(self):
         w = self.dense_quantizer.quant_weight()
         w[:, self.outlier_columns_index] = self.dense_quantizer.weight[
@@ -80,7 +87,7 @@ class OutliersQLinearColumn(nn.Module, BinaryInterface):
     def forward(self, x):
         if not self.outlier_calibrated:
             self.outlier_calibration(x)
-        w = checkpoint(self.binarize_except_outliers)
+        w = self.cached_weight(self.binarize_except_outliers)
         # w = self.binarize_except_outliers()
         output = F.linear(x, w, self.dense_quantizer.bias)
         return output
@@ -3,7 +3,33 @@ import torch.nn as nn
 import torch.nn.functional as F
 import numpy as np
 from torch.utils.checkpoint import checkpoint
-from .quantizer import STEBinary, IrNetBinary, FdaBinary, BinaryInterface
+from .quantizer import STEBinary, IrNetBinary, FdaBinary, BinaryInterface, BinaryExceptOutliers
+from .sparse_outliers import (
+    mask_to_csr,
+    csr_to_mask,
+    csr_index,
+    csr_matrix,
+    sparse_linear,
+    load_csr_state,
+    pack_bits,
+    unpack_bits,
+)
+
+
+def outlier_bounds(w):
+    # per-row mean -+ 1.6 std of w [batch, n]
+    mean = torch.mean(w, -1, keepdim=True)
+    std = torch.std(w, -1, keepdim=True)
+    lower_threshold = mean - 1.6 * std  # 1.6 : 90%, 0.67 : 50%, 1.0, 70%
+    upper_threshold = mean + 1.6 * std  # 1.95 : 95%, 2.3 : 98%, 
+    return lower_threshold, upper_threshold
+
+
+def inlier_abs_mean(w, outliers):
+    # mean |w| over the entries not at the flat indices `outliers`, [1, 1]
+    a = w.detach().abs()
+    total = a.sum() - a.reshape(-1)[outliers].sum()
+    return (total / (w.numel() - outliers.numel())).view(-1, 1)
 
 
 class BinaryXnorExceptOutliersLinear(nn.Module, BinaryInterface):
@@ -15,26 +41,46 @@ class BinaryXnorExceptOutliersLinear(nn.Module, BinaryInterface):
         else:
             self.bias = None
         self.printed = False
-        self.outlier_mask = None
+        # outlier positions as CSR, see sparse_outliers; None until generated
+        self.register_buffer("outlier_crow", None)
+        self.register_buffer("outlier_col", None)
         self.outlier_scale = outlier_scale
-        self.binary_scale = None
+        self.register_buffer("binary_scale", None)
+
+    @property
+    def outlier_mask(self):
+        # dense view, decoded on each access; the layer itself uses
+        # outlier_index
+        if self.outlier_crow is None:
+            return None
+        return csr_to_mask(self.outlier_crow, self.outlier_col, self.weight.shape)
+
+    def outlier_index(self):
+        return csr_index(self.outlier_crow, self.outlier_col, self.weight.shape[1])
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # the buffers are None until calibrated
+        load_csr_state(
+            self, state_dict, prefix, ("outlier_crow", "outlier_col", "binary_scale")
+        )
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+        if self.outlier_crow is not None and self.binary_scale is None:
+            # converted from a legacy dense outlier_mask
+            self.binary_scale = inlier_abs_mean(self.weight, self.outlier_index())
 
     def gen_outlier_mask(self):
         with torch.no_grad():
             w = self.weight
-            w_flat = w.view(-1)
+            w_flat = w.view(1, -1)
             # lower_threshold, upper_threshold = torch.quantile(w_flat, torch.tensor([0.01, 0.99]).to(w.device))
 
-            mean = torch.mean(w_flat).to(w.device)
-            std = torch.std(w_flat).to(w.device)
-            lower_threshold = mean - 1.6 * std  # 1.6 : 90%, 0.67 : 50%, 1.0, 70%
-            upper_threshold = mean + 1.6 * std  # 1.95 : 95%, 2.3 : 98%, 
+            lower_threshold, upper_threshold = outlier_bounds(w_flat)
 
             outliers = (w < lower_threshold) | (w > upper_threshold)
             print(
                 f"Generat outlier_mask, outlier_fraction: {outliers.sum()}/{outliers.numel()}({outliers.sum()/outliers.numel()})"
             )
-            self.outlier_mask = outliers.detach()
+            self.set_outlier_mask(outliers)
 
             # import matplotlib.pyplot as plt
             # import numpy as np
@@ -51,29 +97,81 @@ class BinaryXnorExceptOutliersLinear(nn.Module, BinaryInterface):
             # plt.savefig('./111.pdf')
             # # plt.show()
 
-            self.binary_scale = (
-                w[~self.outlier_mask].abs().mean(-1).view(-1, 1).detach()
-            )
+    def set_outlier_mask(self, outliers):
+        crow, col = mask_to_csr(outliers.detach())
+        self.outlier_crow = crow.to(self.weight.device)
+        self.outlier_col = col.to(self.weight.device)
+        w = self.weight.to(outliers.device)
+        self.binary_scale = (
+            w[~outliers].abs().mean(-1).view(-1, 1).detach().to(self.weight.device)
+        )
 
     def binarize_except_outliers(self):
-        if self.outlier_mask is None:
+        if self.outlier_crow is None:
             self.gen_outlier_mask()
 
         # if self.printed is not True:
         #     print(outliers.sum()/outliers.numel())
         #     self.printed = True
+        index = self.outlier_index()
         if self.training:
-            self.binary_scale = (
-                self.weight[~self.outlier_mask].abs().mean(-1).view(-1, 1).detach()
-            )
-        scaled_weight = self.weight * self.outlier_scale
-        binary_weight = STEBinary().apply(self.weight) * self.binary_scale
-        w_sim = torch.where(self.outlier_mask, scaled_weight, binary_weight)
-        return w_sim
+            self.binary_scale = inlier_abs_mean(self.weight, index)
+        return BinaryExceptOutliers.apply(
+            self.weight, index, self.outlier_scale, self.binary_scale
+        )
+
+    def split_weight(self):
+        # binary weight, which is 0 at the outliers, and the outliers as a
+        # sparse matrix
+        if self.outlier_crow is None:
+            self.gen_outlier_mask()
+        w = self.weight.sign().mul_(self.binary_scale)
+        w.view(-1).index_fill_(0, self.outlier_index(), 0)
+        return w, csr_matrix(self.outlier_crow, self.outlier_col, self.weight)
 
     def forward(self, x):
         # w = STEBinary().apply(self.weight)
-        # w = checkpoint(self.binarize_except_outliers)
-        w = self.binarize_except_outliers()
+        if self.training:
+            # w = checkpoint(self.binarize_except_outliers)
+            w = self.binarize_except_outliers()
+            return F.linear(x, w, self.bias)
+        # binary GEMM plus sparse outlier GEMM
+        w, outliers = self.cached_weight(self.split_weight)
         output = F.linear(x, w, self.bias)
-        return output
+        return output + sparse_linear(x, outliers) * self.outlier_scale
+
+    def get_save_weight_dict(self):
+        # what the layer computes, not the fp16 latent weight: sign bits,
+        # the binary scale and the outliers as CSR indices plus fp16 values
+        if self.outlier_crow is None:
+            self.gen_outlier_mask()
+        w = self.weight.data
+        return {
+            "shape": tuple(w.shape),
+            "bias": self.bias,
+            "signs": pack_bits(w > 0).cpu(),
+            "binary_scale": self.binary_scale.cpu(),
+            "outlier_crow": self.outlier_crow.cpu(),
+            "outlier_col": self.outlier_col.cpu(),
+            "outlier_values": w.reshape(-1)[self.outlier_index()].half().cpu(),
+        }
+
+    @classmethod
+    def from_save_weight_dict(cls, weights):
+        # a latent weight that binarizes to the saved layer: +-binary_scale
+        # off the outliers, the saved values on them
+        rows, cols = weights["shape"]
+        binary_scale = weights["binary_scale"].float()
+        signs = unpack_bits(weights["signs"], cols)
+        w = torch.where(signs, binary_scale, -binary_scale)
+        index = csr_index(weights["outlier_crow"], weights["outlier_col"], cols)
+        w.view(-1)[index] = weights["outlier_values"].float()
+        layer = cls(w, weights["bias"])
+        layer.load_save_weight_dict(weights)
+        return layer
+
+    def load_save_weight_dict(self, weights):
+        device = self.weight.device
+        self.outlier_crow = weights["outlier_crow"].to(device)
+        self.outlier_col = weights["outlier_col"].to(device)
+        self.binary_scale = weights["binary_scale"].to(device)
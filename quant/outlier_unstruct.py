@@ -10,6 +10,16 @@ from .quantizer import (
     BinaryInterface,
     XnorBinaryLinear,
 )
+from .sparse_outliers import (
+    index_dtype,
+    mask_to_csr,
+    csr_to_mask,
+    csr_index,
+    csr_matrix,
+    sparse_linear,
+    load_csr_state,
+)
+from .quantile import kth_smallest
 
 
 class OutliersQLinearUnstruct(nn.Module, BinaryInterface):
@@ -31,59 +41,103 @@ class OutliersQLinearUnstruct(nn.Module, BinaryInterface):
         self.n_outliers = int(outlier_fraction * weight.numel())
         self.register_buffer("outlier_calibrated", torch.tensor(False))
 
+        # outlier positions as CSR, see sparse_outliers
+        self.register_buffer(
+            "outlier_crow", torch.zeros(weight.shape[0] + 1, dtype=torch.int32)
+        )
         self.register_buffer(
-            "outlier_mask",
-            torch.zeros(weight.shape, dtype=torch.bool),
+            "outlier_col", torch.zeros(0, dtype=index_dtype(weight.shape[1]))
         )
         self.outlier_metric = outlier_metric
         self.H_diag = None
 
+    @property
+    def outlier_mask(self):
+        # dense view, decoded on each access; the layer itself uses
+        # outlier_index
+        return csr_to_mask(self.outlier_crow, self.outlier_col, self.dense_quantizer.weight.shape)
+
+    def outlier_index(self):
+        return csr_index(self.outlier_crow, self.outlier_col, self.dense_quantizer.weight.shape[1])
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        load_csr_state(self, state_dict, prefix, ("outlier_crow", "outlier_col"))
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
     def add_batch(self, x):
         if self.outlier_metric == "hessain":
             if self.H_diag is None:
                 self.H_diag = torch.zeros(x.shape[1], device=x.device)
             self.H_diag += (x**2).mean([0, 1])
 
-    def outlier_calibration(self, x=None):
+    def outlier_sensitivity(self, x=None):
+        w = self.dense_quantizer.weight
+        if self.outlier_metric == "L1":
+            sensitivity = w.abs()
+        elif self.outlier_metric == "hessian":
+            # from OWQ: Lessons learned from activation outliers for weight quantization in large language models
+            H_diag = (x * x).mean([0, 1])  # shape ic
+            w_hat = self.dense_quantizer.quant_weight()
+            delta_w = (w_hat - w) ** 2  # shape oc,ic
+            sensitivity = H_diag.view(1, -1) * delta_w  # shape oc,ic
+        else:
+            raise NotImplementedError
+        return sensitivity
+
+    def set_outlier_mask(self, mask):
+        crow, col = mask_to_csr(mask)
+        self.outlier_crow = crow.to(self.outlier_crow.device)
+        self.outlier_col = col.to(self.outlier_col.device)
+        # self.outlier_weight.data = w[:, self.outlier_columns_index]
+        self.outlier_calibrated.data[...] = True
+
+    def outlier_calibration(self, x=None, sample=0):
         with torch.no_grad():
             print(
                 f"calibrating outlier, outlier_fraction={self.outlier_fraction}, metric={self.outlier_metric}"
             )
-            w = self.dense_quantizer.weight
-            if self.outlier_metric == "L1":
-                sensitivity = w.abs()
-            elif self.outlier_metric == "hessian":
-                # from OWQ: Lessons learned from activation outliers for weight quantization in large language models
-                H_diag = (x * x).mean([0, 1])  # shape ic
-                w_hat = self.dense_quantizer.quant_weight()
-                delta_w = (w_hat - w) ** 2  # shape oc,ic
-                sensitivity = H_diag.view(1, -1) * delta_w  # shape oc,ic
-            else:
-                raise NotImplementedError
-            thresh = torch.kthvalue(
-                sensitivity.view(-1), w.numel() - self.n_outliers
-            ).values
-            self.outlier_mask.data = sensitivity >= thresh
-            # self.outlier_weight.data = w[:, self.outlier_columns_index]
-            self.outlier_calibrated.data[...] = True
+            sensitivity = self.outlier_sensitivity(x)
+            thresh = kth_smallest(
+                sensitivity.view(1, -1), sensitivity.numel() - self.n_outliers, sample
+            )
+            self.set_outlier_mask(sensitivity >= thresh)
 
     def binarize_except_outliers(self):
-        w = self.dense_quantizer.quant_weight(outlier_mask=self.outlier_mask)
-        w = torch.where(self.outlier_mask, self.dense_quantizer.weight, w)
-        return w
+        index = self.outlier_index()
+        w = self.dense_quantizer.quant_weight(outliers=index)
+        latent = self.dense_quantizer.weight.reshape(-1)
+        return w.reshape(-1).index_copy(0, index, latent[index]).view_as(w)
+
+    def split_weight(self):
+        # binary weight, which is 0 at the outliers, and the outliers as a
+        # sparse matrix
+        w = self.dense_quantizer.quant_weight(outliers=self.outlier_index())
+        return w, csr_matrix(self.outlier_crow, self.outlier_col, self.dense_quantizer.weight)
 
     def forward(self, x):
         if not self.outlier_calibrated:
             self.outlier_calibration(x)
-        # w = checkpoint(self.binarize_except_outliers)
-        w = self.binarize_except_outliers()
+        if self.training:
+            # w = checkpoint(self.binarize_except_outliers)
+            w = self.binarize_except_outliers()
+            return F.linear(x, w, self.dense_quantizer.bias)
+        # binary GEMM plus sparse outlier GEMM
+        w, outliers = self.cached_weight(self.split_weight)
         output = F.linear(x, w, self.dense_quantizer.bias)
-        return output
+        return output + sparse_linear(x, outliers)
 
     def get_save_weight_dict(self):
         return {
-            "outlier_mask": self.outlier_mask,
+            "weight": self.dense_quantizer.weight.data.half().cpu(),
+            "bias": self.dense_quantizer.bias,
+            "outlier_crow": self.outlier_crow.cpu(),
+            "outlier_col": self.outlier_col.cpu(),
         }
 
+    def load_save_weight_dict(self, weights):
+        self.outlier_crow = weights["outlier_crow"].to(self.outlier_crow.device)
+        self.outlier_col = weights["outlier_col"].to(self.outlier_col.device)
+        self.outlier_calibrated.data[...] = True
+
     def __repr__(self):
         return f"OutliersQLinearUnstruct({self.n_outliers}, outlier_fraction={self.outlier_fraction}, outlier_metric={self.outlier_metric})"
@@ -85,7 +85,7 @@ class OutliersQLinearWindowFix(nn.Module, BinaryInterface):
     def forward(self, x):
         if not self.outlier_calibrated:
             self.outlier_calibration(x)
-        w = checkpoint(self.binarize_except_outliers)
+        w = self.cached_weight(self.binarize_except_outliers)
         # w = self.binarize_except_outliers()
         output = F.linear(x, w, self.dense_quantizer.bias)
         return output
@@ -0,0 +1,19 @@
+import torch
+
+
+def kth_smallest(x, k, sample=0, seed=0):
+    """
+    k-th smallest (1-based) entry of every row of x [batch, n], found by one
+    batched kthvalue. With 0 < `sample` < n the same quantile is taken over
+    `sample` uniformly drawn entries per row instead, an approximate threshold
+    for very large matrices; the seed is fixed so reruns give the same masks.
+    Returns a [batch] tensor.
+    """
+    n = x.shape[1]
+    if sample and sample < n:
+        gen = torch.Generator(device=x.device).manual_seed(seed)
+        idx = torch.randint(n, (x.shape[0], sample), device=x.device, generator=gen)
+        x = x.gather(1, idx)
+        k = round(k * sample / n)
+    k = min(max(k, 1), x.shape[1])
+    return x.kthvalue(k, dim=1).values
@@ -67,10 +67,136 @@ class FdaBinary(torch.autograd.Function):
         return grad_input, None
 
 
+def _center_grad(grad):
+    # gradient through w - w.mean(-1, keepdim=True)
+    return grad - grad.mean(-1, keepdim=True)
+
+
+class XnorBinary(torch.autograd.Function):
+    """
+    sign(c) * mean|c| of the row-centered weight c = w - mean(w), with the
+    entries at the flat indices `outliers` zeroed, and the STE gradient of
+    the plain autograd version (scale detached). Only the per-row scale and
+    the indices are kept for backward.
+    """
+
+    @staticmethod
+    def forward(ctx, w, outliers=None):
+        c = w - w.mean(-1, keepdim=True)
+        if outliers is not None:
+            c.view(-1).index_fill_(0, outliers, 0)
+        scale = c.abs().mean(-1, keepdim=True)
+        ctx.save_for_backward(scale, outliers)
+        return c.sign_().mul_(scale)
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        scale, outliers = ctx.saved_tensors
+        grad = (grad_output * scale).contiguous()
+        if outliers is not None:
+            grad.view(-1).index_fill_(0, outliers, 0)
+        return _center_grad(grad), None
+
+
+class IrNetXnorBinary(torch.autograd.Function):
+    """
+    XnorBinary with the IR-Net gradient k * t * (1 - tanh(c * t)^2) in place
+    of the STE. Keeps the weight itself (a reference to the parameter) and
+    the scale; c is recomputed in backward.
+    """
+
+    @staticmethod
+    def forward(ctx, w, k=10.0, t=0.1):
+        c = w - w.mean(-1, keepdim=True)
+        scale = c.abs().mean(-1, keepdim=True)
+        ctx.save_for_backward(w, scale)
+        ctx.k, ctx.t = k, t
+        return c.sign_().mul_(scale)
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        w, scale = ctx.saved_tensors
+        c = w - w.mean(-1, keepdim=True)
+        grad = ctx.k * ctx.t * (1 - torch.tanh(c * ctx.t) ** 2) * grad_output * scale
+        return _center_grad(grad), None, None
+
+
+class BiRealBinary(torch.autograd.Function):
+    """
+    sign(w) * mean|w| per row, with the gradient of clamp(w, -1, 1).
+    """
+
+    @staticmethod
+    def forward(ctx, w):
+        ctx.save_for_backward(w)
+        return w.sign() * w.abs().mean(-1, keepdim=True)
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        (w,) = ctx.saved_tensors
+        return grad_output.masked_fill(w.abs() > 1, 0)
+
+
+class BinaryExceptOutliers(torch.autograd.Function):
+    """
+    w * outlier_scale at the flat indices `outliers`, sign(w) * binary_scale
+    elsewhere, with the STE gradient; keeps only the indices and the binary
+    scale for backward.
+    """
+
+    @staticmethod
+    def forward(ctx, w, outliers, outlier_scale, binary_scale):
+        out = w.sign().mul_(binary_scale)
+        out.view(-1)[outliers] = w.reshape(-1)[outliers] * outlier_scale
+        ctx.save_for_backward(outliers, binary_scale)
+        ctx.outlier_scale = outlier_scale
+        return out
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        outliers, binary_scale = ctx.saved_tensors
+        grad = (grad_output * binary_scale).contiguous()
+        grad.view(-1)[outliers] = grad_output.reshape(-1)[outliers] * ctx.outlier_scale
+        return grad, None, None, None
+
+
 class BinaryInterface:
     def get_save_weight_dict(self):
         return {"weight": self.weight.data.half().cpu(), "bias": self.bias}
 
+    @classmethod
+    def from_save_weight_dict(cls, weights):
+        # the layer saved as `weights` (get_save_weight_dict)
+        layer = cls(weights["weight"], weights["bias"])
+        layer.load_save_weight_dict(weights)
+        return layer
+
+    def load_save_weight_dict(self, weights):
+        # restore the entries of get_save_weight_dict other than weight and bias
+        pass
+
+    def freeze(self, frozen=True):
+        """
+        Frozen mode, for evaluation and generation: `cached_weight` computes
+        the quantized weight once and reuses it until a parameter or buffer
+        of the layer is replaced or updated in place.
+        """
+        self.frozen = frozen
+        self.quant_cache = None
+
+    def cached_weight(self, quant_weight):
+        # quant_weight(), computed once and cached in frozen mode
+        if not getattr(self, "frozen", False):
+            return quant_weight()
+        key = (self.training,) + tuple(
+            (t.data_ptr(), t._version)
+            for t in list(self.parameters()) + list(self.buffers())
+        )
+        if self.quant_cache is None or self.quant_cache[0] != key:
+            with torch.no_grad():
+                self.quant_cache = (key, quant_weight())
+        return self.quant_cache[1]
+
 
 class BinaryLinear(nn.Module, BinaryInterface):
     def __init__(self, weight, bias) -> None:
@@ -82,7 +208,7 @@ class BinaryLinear(nn.Module, BinaryInterface):
             self.bias = None
 
     def forward(self, x):
-        w = STEBinary().apply(self.weight)
+        w = self.cached_weight(lambda: STEBinary().apply(self.weight))
         return F.linear(x, w, self.bias)
 
 
@@ -96,16 +222,11 @@ class IrBinaryLinear(nn.Module, BinaryInterface):
             self.bias = None
 
     def quant_weight(self):
-        w = self.weight
-        # centeralization
-        w = w - w.mean(-1).view(-1, 1)
-        scaling_factor = w.abs().mean(-1).view(-1, 1).detach()
-        w = IrNetBinary().apply(w)
-        w = w * scaling_factor
-        return w
+        # centeralization, IR-Net binarization, detached mean-abs scaling
+        return IrNetXnorBinary.apply(self.weight)
 
     def forward(self, x):
-        w = checkpoint(self.quant_weight, use_reentrant=False)
+        w = self.cached_weight(self.quant_weight)
         return F.linear(x, w, self.bias)
 
 
@@ -124,7 +245,7 @@ class FdaBinaryLinear(nn.Module, BinaryInterface):
         return w
 
     def forward(self, x):
-        w = checkpoint(self.quant_weight, use_reentrant=False)
+        w = self.cached_weight(self.quant_weight)
         return F.linear(x, w, self.bias)
 
 
@@ -138,15 +259,8 @@ class BiRealLinear(nn.Module, BinaryInterface):
             self.bias = None
 
     def quant_weight(self):
-        real_weights = self.weight
-        scaling_factor = torch.mean(abs(real_weights), dim=1, keepdim=True)
-        scaling_factor = scaling_factor.detach()
-        binary_weights_no_grad = scaling_factor * torch.sign(real_weights)
-        cliped_weights = torch.clamp(real_weights, -1.0, 1.0)
-        binary_weights = (
-            binary_weights_no_grad.detach() - cliped_weights.detach() + cliped_weights
-        )
-        return binary_weights
+        # scaled sign forward, clamp(w, -1, 1) gradient
+        return BiRealBinary.apply(self.weight)
 
     def forward(self, input):
         x = input
@@ -163,7 +277,7 @@ class BiRealLinear(nn.Module, BinaryInterface):
         )
         out3 = out2 * mask3.type(torch.float32) + 1 * (1 - mask3.type(torch.float32))
         input = out_forward.detach() - out3.detach() + out3
-        w = checkpoint(self.quant_weight, use_reentrant=False)
+        w = self.cached_weight(self.quant_weight)
         # y = F.conv2d(x, binary_weights, stride=self.stride, padding=self.padding)
         output = F.linear(input, w)
         return output
@@ -178,16 +292,11 @@ class XnorBinaryLinear(nn.Module, BinaryInterface):
         else:
             self.bias = None
 
-    def quant_weight(self, outlier_mask=None):
-        w = self.weight
-        w = w - w.mean(-1).view(-1, 1)  # oc, ic
-        if outlier_mask is not None:
-            w = w * (~outlier_mask)
-        scaling_factor = w.abs().mean(-1).view(-1, 1).detach()
-        w = STEBinary().apply(w)
-        w = w * scaling_factor
-        return w
+    def quant_weight(self, outliers=None):
+        # centered, outliers (flat indices) zeroed, STE sign times the
+        # detached mean-abs
+        return XnorBinary.apply(self.weight, outliers)
 
     def forward(self, x):
-        w = checkpoint(self.quant_weight, use_reentrant=False)
+        w = self.cached_weight(self.quant_weight)
         return F.linear(x, w, self.bias)
@@ -0,0 +1,85 @@
+import torch
+
+"""
+Outlier masks as CSR index buffers: `crow` [rows + 1] int32 row pointers and
+`col` column indices (int16 when the columns fit). At 5-10% outliers that is
+about 1-2 bits per weight instead of the 8 of a dense bool mask, and the
+outlier values can be multiplied as a sparse matrix.
+"""
+
+
+def index_dtype(columns):
+    return torch.int16 if columns <= 2**15 else torch.int32
+
+
+def mask_to_csr(mask):
+    rows, cols = mask.shape
+    crow = torch.zeros(rows + 1, dtype=torch.int32, device=mask.device)
+    crow[1:] = torch.cumsum(mask.sum(1), 0)
+    col = mask.nonzero()[:, 1].to(index_dtype(cols))
+    return crow, col
+
+
+def csr_rows(crow):
+    # row index of every stored entry
+    counts = (crow[1:] - crow[:-1]).long()
+    return torch.repeat_interleave(torch.arange(len(counts), device=crow.device), counts)
+
+
+def csr_to_mask(crow, col, shape):
+    mask = torch.zeros(shape, dtype=torch.bool, device=col.device)
+    mask[csr_rows(crow), col.long()] = True
+    return mask
+
+
+def csr_index(crow, col, columns):
+    # flat (row-major) index of every stored entry, for gathering and
+    # scattering the outliers without a dense mask
+    return csr_rows(crow) * columns + col.long()
+
+
+def load_csr_state(module, state_dict, prefix, names):
+    """
+    Before module._load_from_state_dict: convert a legacy dense
+    `outlier_mask` to CSR and give the buffers `names` the shape and dtype of
+    the incoming tensors, as their size is only known after calibration.
+    """
+    mask = state_dict.pop(prefix + "outlier_mask", None)
+    if mask is not None:
+        crow, col = mask_to_csr(mask.bool())
+        state_dict[prefix + "outlier_crow"] = crow
+        state_dict[prefix + "outlier_col"] = col
+    device = next(module.parameters()).device
+    for name in names:
+        t = state_dict.get(prefix + name)
+        if t is not None:
+            setattr(module, name, torch.empty_like(t, device=device))
+
+
+def pack_bits(bits):
+    # bool [rows, cols] -> uint8 [rows, ceil(cols / 8)], little-endian in a byte
+    pad = (-bits.shape[-1]) % 8
+    bits = torch.nn.functional.pad(bits.to(torch.uint8), (0, pad))
+    bits = bits.reshape(*bits.shape[:-1], -1, 8)
+    shifts = torch.arange(8, dtype=torch.uint8, device=bits.device)
+    return (bits << shifts).sum(-1, dtype=torch.uint8)
+
+
+def unpack_bits(packed, cols):
+    shifts = torch.arange(8, dtype=torch.uint8, device=packed.device)
+    bits = (packed.unsqueeze(-1) >> shifts) & 1
+    return bits.reshape(*packed.shape[:-1], -1)[..., :cols].bool()
+
+
+def csr_matrix(crow, col, dense):
+    # sparse CSR matrix holding `dense` at the stored positions, with int32
+    # indices and values in the dtype of `dense`
+    values = dense.reshape(-1)[csr_index(crow, col, dense.shape[1])]
+    return torch.sparse_csr_tensor(crow, col.int(), values, dense.shape)
+
+
+def sparse_linear(x, sparse):
+    # x @ sparse.T, in the dtype of the sparse values
+    x2 = x.reshape(-1, x.shape[-1]).to(sparse.dtype)
+    y = torch.sparse.mm(sparse, x2.t()).t()
+    return y.to(x.dtype).reshape(*x.shape[:-1], sparse.shape[0])
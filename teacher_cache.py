@@ -0,0 +1,116 @@
+import json
+import os
+
+import numpy as np
+import torch
+
+"""
+Offline teacher outputs for distillation: the top-k logits of every token of
+a training set, computed once and read back instead of running the teacher on
+every step. A cache directory holds shards of at most `shard_tokens` tokens,
+values_<i>.bin (fp16 [tokens, k]) and indices_<i>.bin (int32 [tokens, k]),
+which are memory-mapped on read, and index.npy mapping each sample id to its
+(shard, first token, length).
+"""
+
+
+class TeacherLogitCache:
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'meta.json')) as f:
+            self.meta = json.load(f)
+        self.k = self.meta['k']
+        self.index = np.load(os.path.join(path, 'index.npy'))
+        self.values, self.indices = [], []
+        for i, n in enumerate(self.meta['shards']):
+            self.values.append(np.memmap(os.path.join(path, f'values_{i}.bin'), dtype=np.float16,
+                                         mode='r', shape=(n, self.k)))
+            self.indices.append(np.memmap(os.path.join(path, f'indices_{i}.bin'), dtype=np.int32,
+                                          mode='r', shape=(n, self.k)))
+
+    def __len__(self):
+        return len(self.index)
+
+    def sample(self, i):
+        # ([length, k] values, [length, k] vocabulary indices) of sample i
+        shard, st, n = self.index[i]
+        if shard < 0:
+            raise KeyError(f'sample {i} is not in the teacher cache {self.path}')
+        return self.values[shard][st:st + n], self.indices[shard][st:st + n]
+
+    def lengths(self, ids):
+        # cached token counts of samples `ids`, without touching the shards
+        return [int(n) for n in self.index[ids, 2]]
+
+    def tokens(self, ids, device=None):
+        # top-k of samples `ids`, concatenated in order as [tokens, k] tensors
+        values, indices = zip(*(self.sample(i) for i in ids))
+        return (torch.from_numpy(np.concatenate(values)).to(device),
+                torch.from_numpy(np.concatenate(indices)).to(device))
+
+    @staticmethod
+    @torch.no_grad()
+    def build(path, teacher, data, k=64, index_column='teacher_index', batch_size=8,
+              shard_tokens=2 ** 24, chunk=1024, meta=None):
+        """
+        Run `teacher` over the `input_ids` of `data`, `batch_size` right-padded
+        samples at a time, and store the top-k logits of every token under the
+        sample id in `index_column`. lm_head + topk run `chunk` tokens at a time.
+        """
+        os.makedirs(path, exist_ok=True)
+        ids = data[index_column]
+        index = np.full((max(ids) + 1, 3), -1, dtype=np.int64)
+        shards = [0]
+        files = None
+        dev = teacher.get_input_embeddings().weight.device
+        for st in range(0, len(data), batch_size):
+            rows = data[st:st + batch_size]
+            lens = [len(x) for x in rows['input_ids']]
+            input_ids = torch.zeros((len(lens), max(lens)), dtype=torch.long)
+            attention_mask = torch.zeros_like(input_ids)
+            for j, x in enumerate(rows['input_ids']):
+                input_ids[j, :lens[j]] = torch.tensor(x)
+                attention_mask[j, :lens[j]] = 1
+            hidden = teacher.model(input_ids=input_ids.to(dev), attention_mask=attention_mask.to(dev))[0]
+            for j, n in enumerate(lens):
+                if files is None or (shards[-1] and shards[-1] + n > shard_tokens):
+                    if files is not None:
+                        shards.append(0)
+                        for f in files:
+                            f.close()
+                    i = len(shards) - 1
+                    files = (open(os.path.join(path, f'values_{i}.bin'), 'wb'),
+                             open(os.path.join(path, f'indices_{i}.bin'), 'wb'))
+                index[rows[index_column][j]] = (len(shards) - 1, shards[-1], n)
+                for c in range(0, n, chunk):
+                    logits = teacher.lm_head(hidden[j, c:min(c + chunk, n)]).float()
+                    values, indices = logits.topk(k, dim=-1)
+                    files[0].write(values.half().cpu().numpy().tobytes())
+                    files[1].write(indices.int().cpu().numpy().tobytes())
+                shards[-1] += n
+            print(f'teacher cache: {min(st + batch_size, len(data))}/{len(data)} samples')
+        for f in files or ():
+            f.close()
+        np.save(os.path.join(path, 'index.npy'), index)
+        # written last: a cache without meta.json is incomplete and rebuilt
+        with open(os.path.join(path, 'meta.json'), 'w') as f:
+            json.dump(dict(meta or {}, k=k, shards=shards, samples=len(data)), f)
+
+
+def teacher_logit_cache(path, data, teacher, k=64, meta=None, **kwargs):
+    """
+    Open the TeacherLogitCache at `path`, building it on a miss, i.e. when it
+    is missing or was built with another k, number of samples or `meta`.
+    `teacher()` returns the teacher model and is only called on a miss.
+    """
+    meta = meta or {}
+    meta_path = os.path.join(path, 'meta.json')
+    if os.path.exists(meta_path):
+        with open(meta_path) as f:
+            cached = json.load(f)
+        if cached['k'] == k and cached['samples'] == len(data) and all(cached.get(key) == v for key, v in meta.items()):
+            return TeacherLogitCache(path)
+        os.remove(meta_path)
+    print(f'building teacher logit cache {path}')
+    TeacherLogitCache.build(path, teacher(), data, k, meta=meta, **kwargs)
+    return TeacherLogitCache(path)
@@ -62,6 +62,17 @@ def prepare_model_for_eval(model):
     return model
 
 
+def freeze_quant_weights(model, frozen=True):
+    """
+    Put every binary layer of `model` in (or out of) frozen mode, where its
+    quantized weight is computed once and cached; see BinaryInterface.freeze.
+    """
+    for module in model.modules():
+        if isinstance(module, quant.BinaryInterface):
+            module.freeze(frozen)
+    return model
+
+
 def get_bnn_meta(model):
     meta = {}
     for name, module in model.named_modules():
@@ -111,13 +122,18 @@ def load_bnn(model, load_path):
             # choose binariztaion method
             if name in bnn_meta:
                 binarization_method = bnn_meta[name]
-                weight = bnn_weights[name + "_weight"]
                 # weight = bnn_weights[name]
-                bias = bnn_weights[name + "_bias"]
                 # weight=weight.to(module.weight.device)
                 # if bias is not None:
                 #     bias=bias.to(module.weight.device)
-                qlinear = getattr(quant, binarization_method)(weight, bias)
+                prefix = name + "_"
+                qlinear = getattr(quant, binarization_method).from_save_weight_dict(
+                    {
+                        k[len(prefix) :]: v
+                        for k, v in bnn_weights.items()
+                        if k.startswith(prefix)
+                    }
+                )
 
                 setattr(father, name[ind + 1 :], qlinear)
                 print(f"replace layer {name} with {qlinear}")